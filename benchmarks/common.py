@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+from datetime import datetime
+
+from services.fields import NAME, PRICE, QUANTITY
+from services.items_combiner import ItemsCombiner
+
+PERCENTILES = (50, 95)
+NAME_SIMILARITY_THRESHOLD = 0.5
+
+
+def percentile(values, rank):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(rank / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def latency_summary(latencies):
+    summary = {"p{}".format(rank): percentile(latencies, rank) for rank in PERCENTILES}
+    summary["mean"] = sum(latencies) / len(latencies) if latencies else 0.0
+    summary["max"] = max(latencies) if latencies else 0.0
+    return summary
+
+
+def cpu_time():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def peak_rss_kb():
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+
+
+def items_accuracy(extracted_items, expected_items):
+    combiner = ItemsCombiner()
+    unmatched = list(expected_items)
+    matched = 0
+    for item in extracted_items:
+        tokens = combiner.tokenize(item[NAME])
+        for expected in unmatched:
+            expected_tokens = combiner.tokenize(expected[NAME])
+            shared = len(tokens & expected_tokens)
+            same_name = shared and combiner.similarity(shared, tokens, expected_tokens) >= NAME_SIMILARITY_THRESHOLD
+            same_values = float(item[PRICE]) == float(expected[PRICE]) and \
+                int(item[QUANTITY]) == int(expected[QUANTITY])
+            if same_name and same_values:
+                unmatched.remove(expected)
+                matched += 1
+                break
+
+    precision = matched / len(extracted_items) if extracted_items else 0.0
+    recall = matched / len(expected_items) if expected_items else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"matched": matched, "precision": precision, "recall": recall, "f1": f1}
+
+
+def load_manifest(corpus_path):
+    with open(os.path.join(corpus_path, "manifest.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+class Stopwatch:
+    def __enter__(self):
+        self.wall_start, self.cpu_start = time.perf_counter(), cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = cpu_time() - self.cpu_start
+
+
+def write_report(name, results, output=None):
+    report = {
+        "benchmark": name,
+        "created_at": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results
+    }
+    report_view = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(report_view)
+    print(report_view)
+    return report
+
+
+def compare_reports(report, baseline_path, keys):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    for key in keys:
+        current_value, baseline_value = report["results"].get(key), baseline.get(key)
+        if isinstance(current_value, (int, float)) and isinstance(baseline_value, (int, float)) and baseline_value:
+            print("{key}: {baseline:.4f} -> {current:.4f} ({delta:+.1%})".format(
+                key=key, baseline=baseline_value, current=current_value,
+                delta=(current_value - baseline_value) / baseline_value
+            ))
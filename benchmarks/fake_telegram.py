@@ -0,0 +1,96 @@
+import json
+import time
+import asyncio
+import itertools
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+
+class FakeTelegramServer:
+    API_PATH = "/bot{token}/{method}"
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = Counter()
+        self.messages = {}
+        self.chat_messages = defaultdict(list)
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self._methods = {
+            "getMe": self.get_me,
+            "sendMessage": self.send_message,
+            "editMessageText": self.edit_message_text
+        }
+
+    @property
+    def url(self):
+        return "http://{host}:{port}".format(host=self.host, port=self.port)
+
+    @property
+    def api_url(self):
+        return self.url + self.API_PATH
+
+    def get_me(self, data):
+        return self.BOT_USER
+
+    def _message(self, chat_id, message_id):
+        message = self.messages[(chat_id, message_id)]
+        result = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.BOT_USER,
+            "text": message["text"]
+        }
+        if message["reply_markup"]:
+            result["reply_markup"] = message["reply_markup"]
+        return result
+
+    def send_message(self, data):
+        chat_id, message_id = int(data["chat_id"]), next(self._message_ids)
+        self.messages[(chat_id, message_id)] = {
+            "text": data.get("text", ""),
+            "reply_markup": json.loads(data.get("reply_markup") or "null")
+        }
+        self.chat_messages[chat_id].append(message_id)
+        return self._message(chat_id, message_id)
+
+    def edit_message_text(self, data):
+        chat_id, message_id = int(data["chat_id"]), int(data["message_id"])
+        self.messages[(chat_id, message_id)] = {
+            "text": data.get("text", ""),
+            "reply_markup": json.loads(data.get("reply_markup") or "null")
+        }
+        return self._message(chat_id, message_id)
+
+    def chat_texts(self, chat_id):
+        return [self.messages[(chat_id, message_id)]["text"] for message_id in self.chat_messages[chat_id]]
+
+    async def api_handler(self, request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        handler = self._methods.get(method)
+        result = handler(data) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.API_PATH, self.api_handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.host, self.port = self._runner.addresses[0][:2]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
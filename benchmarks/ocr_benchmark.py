@@ -0,0 +1,61 @@
+import os
+import asyncio
+import argparse
+
+from services.img_parser import ImageParser
+from utils.metrics import STAGE_DURATION
+from benchmarks.common import Stopwatch, load_manifest, latency_summary, items_accuracy, peak_rss_kb, \
+    write_report, compare_reports
+
+DEFAULT_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "ocr")
+COMPARED_KEYS = ["throughput", "latency_p50", "latency_p95", "cpu_per_receipt", "f1"]
+
+
+async def run(corpus_path, repeat):
+    manifest = load_manifest(corpus_path)
+    parser = ImageParser()
+    latencies, cases = [], []
+    await parser.warm_up()
+
+    with Stopwatch() as total:
+        for _ in range(repeat):
+            for case in manifest["receipts"]:
+                image_path = os.path.normpath(os.path.join(corpus_path, case["image"]))
+                with Stopwatch() as stopwatch:
+                    items = await parser.parse(image_path)
+                latencies.append(stopwatch.wall)
+                cases.append(dict(image=case["image"], latency=stopwatch.wall, items_count=len(items),
+                                  **items_accuracy(items, case["items"])))
+        parser.close(wait=True)
+
+    latency = latency_summary(latencies)
+    return {
+        "receipts": len(latencies),
+        "throughput": len(latencies) / total.wall if total.wall else 0.0,
+        "latency_p50": latency["p50"],
+        "latency_p95": latency["p95"],
+        "latency": latency,
+        "cpu_per_receipt": total.cpu / len(latencies) if latencies else 0.0,
+        "peak_rss_kb": peak_rss_kb(),
+        "f1": sum(case["f1"] for case in cases) / len(cases) if cases else 0.0,
+        "stages": STAGE_DURATION.totals(),
+        "cases": cases
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark OCR receipt parsing over a recorded corpus")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_PATH)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.corpus, args.repeat))
+    report = write_report("ocr", results, args.output)
+    if args.baseline:
+        compare_reports(report, args.baseline, COMPARED_KEYS)
+
+
+if __name__ == "__main__":
+    main()
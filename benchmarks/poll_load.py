@@ -0,0 +1,312 @@
+import re
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from decimal import Decimal
+from fractions import Fraction
+from collections import Counter, defaultdict
+
+import mongomock
+from pymongo import MongoClient
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot import api
+
+from bot.receipt_bot import ReceiptBot
+from bot.instrumented_bot import InstrumentedBot
+from db.db_connectors import ReceiptsDBConnector, InMemoryConnector
+from db.fields import RECEIPT_ID, CHAT_ID, PAYER_ID, BALANCES, CLEAN_ITEMS, VOTERS_COUNT, TOTAL_VOTERS_COUNT
+from services.fields import NAME, PRICE, QUANTITY
+from services.settlement import Settlement
+from benchmarks.stub_server import RecordedResponsesServer
+from benchmarks.fake_telegram import FakeTelegramServer
+from benchmarks.qr_benchmark import stub_parser_class
+from benchmarks.common import Stopwatch, latency_summary, peak_rss_kb, write_report, compare_reports
+
+FAKE_TOKEN = "123456:poll-load"
+OWNER_ID_BASE = 10 ** 6
+VOTER_ID_BASE = 2 * 10 ** 6
+ITEM_NAMES = ["пиво", "чай", "пицца", "салат", "суп", "паста", "стейк", "кофе", "десерт", "сок", "вино", "хлеб"]
+DEBT_REGEXP = re.compile(r"Ваш долг по чеку составляет (\d+\.\d{2}) руб")
+LINK_REGEXP = re.compile(r"\?start=" + ReceiptBot.DEEP_LINK_TRIGGER + r"(\w+)")
+COMPARED_KEYS = ["throughput", "latency_p50", "latency_p95", "telegram_calls_per_vote"]
+
+
+class ShadowReceipt:
+    def __init__(self, receipt_bot, receipt):
+        self.receipt_bot = receipt_bot
+        self.receipt_id = receipt[RECEIPT_ID]
+        self.items = receipt[CLEAN_ITEMS]
+        self.total_voters_count = receipt[TOTAL_VOTERS_COUNT]
+        self.settlement = Settlement(self.items, self.total_voters_count)
+        self.users = {}
+
+    def apply(self, user_id, callback_data):
+        user_id = str(user_id)
+        user = self.users.setdefault(user_id, self.receipt_bot._get_user_document(user_id))
+        self.receipt_bot.markup.update_poll_state(
+            callback=self.receipt_bot.markup.callback_data.unpack(callback_data),
+            user=user,
+            settlement=self.settlement,
+            items=self.items,
+            total_voters_count=self.total_voters_count
+        )
+
+    def expected_debts(self):
+        debts = defaultdict(Fraction)
+        for item_id, claims in self.settlement.claims.items():
+            item = self.items[int(item_id)]
+            claimed_quantity = Fraction(sum(claims.values()), self.settlement.units_per_quantity)
+            denominator = max(claimed_quantity, int(item[QUANTITY]) or 1)
+            for user_id, units in claims.items():
+                quantity = Fraction(units, self.settlement.units_per_quantity)
+                debts[user_id] += Fraction(str(item[PRICE])) * quantity / denominator
+        return debts
+
+
+class PollLoad:
+    def __init__(self, receipts, voters, taps, items, shared_voters=False, api_latency=0.0, mongo_uri=None, seed=0,
+                 redeliver=0.0):
+        self.receipts_count = receipts
+        self.voters_count = voters
+        self.taps = taps
+        self.items_count = items
+        self.shared_voters = shared_voters
+        self.mongo_uri = mongo_uri
+        self.redeliver = redeliver
+        self.redelivered = Counter()
+        self.random = random.Random(seed)
+        self.fake_api = FakeTelegramServer(latency=api_latency)
+        self.qr_stub = RecordedResponsesServer()
+        self.update_ids = itertools.count(1)
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.dispatcher = None
+        self.receipt_bot = None
+
+    async def setup(self):
+        await self.fake_api.start()
+        api.API_URL = self.fake_api.api_url
+
+        self.dispatcher = Dispatcher(bot=InstrumentedBot(token=FAKE_TOKEN))
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+
+        client = MongoClient(self.mongo_uri) if self.mongo_uri else mongomock.MongoClient()
+        self.receipt_bot = ReceiptBot(
+            self.dispatcher,
+            db=ReceiptsDBConnector(client=client),
+            qr_parser=stub_parser_class(self.qr_stub.start().url)(),
+            dedup_store=InMemoryConnector()
+        )
+        await self.receipt_bot.prepare_db()
+        self.receipt_bot.register_handlers(self.dispatcher)
+
+    async def teardown(self):
+        await self.dispatcher.bot.close()
+        await self.fake_api.stop()
+        self.qr_stub.stop()
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "user{}".format(user_id)}
+
+    def message(self, user_id, text, message_id=None):
+        return {
+            "message_id": message_id or next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+            "text": text
+        }
+
+    async def process(self, kind, **update):
+        update = types.Update.to_object(dict(update_id=next(self.update_ids), **update))
+        copies = 2 if self.random.random() < self.redeliver else 1
+        self.redelivered[kind] += copies - 1
+        start_time = time.perf_counter()
+        try:
+            await asyncio.gather(*[self.dispatcher.process_updates([update]) for _ in range(copies)])
+        except Exception:
+            self.errors[kind] += 1
+        finally:
+            self.latencies[kind].append(time.perf_counter() - start_time)
+
+    async def send_text(self, kind, user_id, text):
+        await self.process(kind, message=self.message(user_id, text))
+
+    async def press(self, kind, user_id, message_id, callback_data):
+        await self.process(kind, callback_query={
+            "id": str(next(self.update_ids)),
+            "from": self.user(user_id),
+            "message": self.message(user_id, "", message_id=message_id),
+            "chat_instance": str(user_id),
+            "data": callback_data
+        })
+
+    def random_items(self):
+        return [
+            {
+                NAME: "{name} {index}".format(name=self.random.choice(ITEM_NAMES), index=index),
+                QUANTITY: self.random.randint(1, 4),
+                PRICE: self.random.randint(5000, 200000) / 100
+            }
+            for index in range(self.items_count)
+        ]
+
+    def voter_ids(self, receipt_index):
+        first_voter = VOTER_ID_BASE if self.shared_voters else VOTER_ID_BASE + receipt_index * self.voters_count
+        return list(range(first_voter, first_voter + self.voters_count))
+
+    async def create_receipt(self, receipt_index):
+        owner_id = OWNER_ID_BASE + receipt_index
+        message = types.Message.to_object(self.message(owner_id, "фото чека"))
+        await self.receipt_bot.save_receipt_and_ask_for_voters_count(message, self.random_items())
+        await self.send_text("voters_count", owner_id, str(self.voters_count))
+
+        for text in reversed(self.fake_api.chat_texts(owner_id)):
+            link = LINK_REGEXP.search(text)
+            if link:
+                receipt = self.receipt_bot._db.get_receipt(keys={RECEIPT_ID: link.group(1)})
+                return ShadowReceipt(self.receipt_bot, receipt)
+        raise RuntimeError("No deeplink was sent to owner {}".format(owner_id))
+
+    def poll_buttons(self, chat_id, receipt_id):
+        unpack = self.receipt_bot.markup.callback_data.unpack
+        for message_id in reversed(self.fake_api.chat_messages[chat_id]):
+            reply_markup = self.fake_api.messages[(chat_id, message_id)]["reply_markup"] or {}
+            buttons = [button for row in reply_markup.get("inline_keyboard", []) for button in row]
+            callbacks = [unpack(button["callback_data"]) for button in buttons]
+            if callbacks and callbacks[0] and callbacks[0].receipt_id == receipt_id:
+                return message_id, [button["callback_data"] for button in buttons], callbacks
+        raise RuntimeError("No poll for receipt {} in chat {}".format(receipt_id, chat_id))
+
+    async def vote(self, shadow, voter_id):
+        await self.send_text("start", voter_id, "/start {}{}".format(ReceiptBot.DEEP_LINK_TRIGGER, shadow.receipt_id))
+        close_action = self.receipt_bot.markup.callback_data.CLOSE_POLL
+        for _ in range(self.taps):
+            message_id, buttons, callbacks = self.poll_buttons(voter_id, shadow.receipt_id)
+            data = self.random.choice([data for data, callback in zip(buttons, callbacks) if callback.action != close_action])
+            shadow.apply(voter_id, data)
+            await self.press("tap", voter_id, message_id, data)
+
+        message_id, buttons, callbacks = self.poll_buttons(voter_id, shadow.receipt_id)
+        data = next(data for data, callback in zip(buttons, callbacks) if callback.action == close_action)
+        shadow.apply(voter_id, data)
+        double_tap = self.random.random() < self.redeliver
+        self.redelivered["double_tap"] += double_tap
+        await asyncio.gather(*[self.press("close", voter_id, message_id, data) for _ in range(1 + double_tap)])
+
+    def check_debts(self, shadows):
+        receipts_closed, lost_updates, unbalanced_receipts, unbalanced_ledgers = 0, 0, 0, 0
+        expected_debts, user_receipts = defaultdict(Fraction), Counter()
+        for shadow in shadows:
+            receipt = self.receipt_bot._db.get_receipt(keys={RECEIPT_ID: shadow.receipt_id})
+            settlement = self.receipt_bot.settlement(receipt)
+            receipts_closed += receipt[VOTERS_COUNT] == receipt[TOTAL_VOTERS_COUNT]
+            lost_updates += sum(
+                settlement.claims.get(item_id, {}) != claims for item_id, claims in shadow.settlement.claims.items()
+            )
+
+            kopecks = Settlement.KOPECKS_IN_RUBLE
+            unclaimed_kopecks = round(settlement.unclaimed_total * kopecks)
+            unbalanced_receipts += abs(sum(settlement.debts().values()) + unclaimed_kopecks - settlement.total * kopecks) > 1
+
+            balances = self.receipt_bot._db.get_balances(chat_id=receipt[CHAT_ID]).get(BALANCES, {})
+            expected_credit = sum(debt for user_id, debt in settlement.debts().items() if user_id != receipt[PAYER_ID])
+            unbalanced_ledgers += sum(balances.values()) != 0 or balances.get(receipt[PAYER_ID], 0) != expected_credit
+
+            shadow_debts = shadow.expected_debts()
+            for user_id in shadow.users:
+                expected_debts[user_id] += shadow_debts.get(user_id, Fraction(0))
+                user_receipts[user_id] += 1
+
+        debt_mismatches = 0
+        for user_id, expected_debt in expected_debts.items():
+            reported_debt = sum(
+                Decimal(debt.group(1)) for text in self.fake_api.chat_texts(int(user_id))
+                for debt in [DEBT_REGEXP.search(text)] if debt
+            )
+            tolerance = Fraction(user_receipts[user_id], Settlement.KOPECKS_IN_RUBLE)
+            debt_mismatches += abs(Fraction(reported_debt) - expected_debt) > tolerance
+        return {
+            "receipts_closed": receipts_closed,
+            "lost_updates": lost_updates,
+            "unbalanced_receipts": unbalanced_receipts,
+            "unbalanced_ledgers": unbalanced_ledgers,
+            "debt_mismatches": debt_mismatches,
+            "checked_users": len(expected_debts)
+        }
+
+    async def run(self):
+        await self.setup()
+        try:
+            with Stopwatch() as setup_time:
+                shadows = await asyncio.gather(*[self.create_receipt(index) for index in range(self.receipts_count)])
+
+            setup_calls = sum(self.fake_api.calls.values())
+            with Stopwatch() as vote_time:
+                await asyncio.gather(*[
+                    self.vote(shadow, voter_id)
+                    for receipt_index, shadow in enumerate(shadows)
+                    for voter_id in self.voter_ids(receipt_index)
+                ])
+            vote_calls = sum(self.fake_api.calls.values()) - setup_calls
+        finally:
+            await self.teardown()
+
+        votes = len(self.latencies["tap"]) + len(self.latencies["close"])
+        updates = votes + len(self.latencies["start"])
+        handler_latencies = self.latencies["start"] + self.latencies["tap"] + self.latencies["close"]
+        handler_latency = latency_summary(handler_latencies)
+        return {
+            "receipts": self.receipts_count,
+            "voters_per_receipt": self.voters_count,
+            "taps_per_voter": self.taps,
+            "updates": updates,
+            "setup_seconds": setup_time.wall,
+            "vote_seconds": vote_time.wall,
+            "throughput": updates / vote_time.wall if vote_time.wall else 0.0,
+            "latency_p50": handler_latency["p50"],
+            "latency_p95": handler_latency["p95"],
+            "latency": {kind: latency_summary(latencies) for kind, latencies in self.latencies.items()},
+            "cpu_per_update": vote_time.cpu / updates if updates else 0.0,
+            "telegram_calls_per_vote": vote_calls / votes if votes else 0.0,
+            "telegram_calls": dict(self.fake_api.calls),
+            "errors": dict(self.errors),
+            "redelivered": dict(self.redelivered),
+            "peak_rss_kb": peak_rss_kb(),
+            "correctness": self.check_debts(shadows)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive concurrent group polls against a fake Telegram Bot API")
+    parser.add_argument("--receipts", type=int, default=20)
+    parser.add_argument("--voters", type=int, default=5)
+    parser.add_argument("--taps", type=int, default=10)
+    parser.add_argument("--items", type=int, default=15)
+    parser.add_argument("--shared-voters", action="store_true", help="the same voters take part in every receipt")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API response delay, seconds")
+    parser.add_argument("--mongo-uri", help="use a real MongoDB instead of mongomock (poll_db is dropped!)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redeliver", type=float, default=0.0,
+                        help="share of updates delivered twice and of double-tapped close buttons")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    load = PollLoad(
+        receipts=args.receipts, voters=args.voters, taps=args.taps, items=args.items,
+        shared_voters=args.shared_voters, api_latency=args.api_latency, mongo_uri=args.mongo_uri, seed=args.seed,
+        redeliver=args.redeliver
+    )
+    results = asyncio.run(load.run())
+    report = write_report("poll_load", results, args.output)
+    if args.baseline:
+        compare_reports(report, args.baseline, COMPARED_KEYS)
+
+
+if __name__ == "__main__":
+    main()
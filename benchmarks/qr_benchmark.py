@@ -0,0 +1,74 @@
+import os
+import asyncio
+import argparse
+from urllib.parse import urlparse
+
+from services.qr_parser import QRParser
+from utils.metrics import EXTERNAL_REQUEST_DURATION
+from benchmarks.stub_server import RecordedResponsesServer
+from benchmarks.common import Stopwatch, load_manifest, latency_summary, items_accuracy, peak_rss_kb, \
+    write_report, compare_reports
+
+DEFAULT_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "qr")
+COMPARED_KEYS = ["throughput", "latency_p50", "latency_p95", "cpu_per_receipt", "f1"]
+STUBBED_URLS = ["AUTH_URL", "TICKET_URL", "TICKETS_URL", "BACKUP_TICKETS_URL", "TINKOFF_FNS_NLP_URL"]
+
+
+def stub_parser_class(stub_url):
+    urls = {}
+    for attribute in STUBBED_URLS:
+        parsed_url = urlparse(getattr(QRParser, attribute))
+        urls[attribute] = stub_url + parsed_url.path
+    return type("StubQRParser", (QRParser,), urls)
+
+
+async def run(corpus_path, repeat):
+    manifest = load_manifest(corpus_path)
+    server = RecordedResponsesServer().start()
+    latencies, cases = [], []
+    try:
+        parser_class = stub_parser_class(server.url)
+        with Stopwatch() as total:
+            for _ in range(repeat):
+                for case in manifest["receipts"]:
+                    server.replay(case["responses"])
+                    with Stopwatch() as stopwatch:
+                        items = await parser_class().get_ticket_items(qr=case["qr"])
+                    latencies.append(stopwatch.wall)
+                    cases.append(dict(qr=case["qr"], latency=stopwatch.wall, items_count=len(items),
+                                      **items_accuracy(items, case["items"])))
+    finally:
+        server.stop()
+
+    latency = latency_summary(latencies)
+    return {
+        "receipts": len(latencies),
+        "throughput": len(latencies) / total.wall if total.wall else 0.0,
+        "latency_p50": latency["p50"],
+        "latency_p95": latency["p95"],
+        "latency": latency,
+        "cpu_per_receipt": total.cpu / len(latencies) if latencies else 0.0,
+        "peak_rss_kb": peak_rss_kb(),
+        "f1": sum(case["f1"] for case in cases) / len(cases) if cases else 0.0,
+        "requests": server.hits,
+        "external_requests": EXTERNAL_REQUEST_DURATION.totals(),
+        "cases": cases
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded FTS/OFD/Tinkoff responses through QRParser")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS_PATH)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.corpus, args.repeat))
+    report = write_report("qr", results, args.output)
+    if args.baseline:
+        compare_reports(report, args.baseline, COMPARED_KEYS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import json
+import time
+import threading
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class RecordedResponseHandler(BaseHTTPRequestHandler):
+    def _reply(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        key = "{method} {path}".format(method=self.command, path=urlparse(self.path).path)
+        recorded = self.server.responses.get(key, {"status": 404, "body": {}})
+        time.sleep(recorded.get("delay", 0))
+
+        body = json.dumps(recorded.get("body", {}), ensure_ascii=False).encode()
+        self.send_response(recorded.get("status", 200))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.hits[key] = self.server.hits.get(key, 0) + 1
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RecordedResponsesServer:
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = ThreadingHTTPServer((host, port), RecordedResponseHandler)
+        self._server.responses = {}
+        self._server.hits = {}
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{host}:{port}".format(host=host, port=port)
+
+    @property
+    def hits(self):
+        return self._server.hits
+
+    def replay(self, responses):
+        self._server.responses = responses
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
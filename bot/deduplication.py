@@ -0,0 +1,22 @@
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from utils.logger import behavior_log
+from utils.metrics import DUPLICATE_UPDATES
+
+
+class UpdateDeduplicator(BaseMiddleware):
+    # Telegram keeps undelivered updates for 24 hours
+    UPDATE_TTL = 24 * 60 * 60
+    UPDATE_KEY_PATTERN = "update:{update_id}"
+
+    def __init__(self, store):
+        super().__init__()
+        self._store = store
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if not self._store.set_if_absent(self.UPDATE_KEY_PATTERN.format(update_id=update.update_id), 1, self.UPDATE_TTL):
+            DUPLICATE_UPDATES.inc(kind="update")
+            behavior_log("Skip redelivered update {update_id}", level="WARNING", update_id=update.update_id)
+            raise CancelHandler()
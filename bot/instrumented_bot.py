@@ -0,0 +1,9 @@
+from aiogram import Bot
+
+from utils.metrics import TELEGRAM_REQUEST_DURATION
+
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        with TELEGRAM_REQUEST_DURATION.time(method=method):
+            return await super().request(method, data, files, **kwargs)
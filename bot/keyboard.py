@@ -1,18 +1,42 @@
-from copy import copy
+import math
+import struct
+import base64
 from fractions import Fraction
+from collections import namedtuple
 
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 
-from db.fields import TOTAL_VOTERS_COUNT
-from services.fields import NAME, QUANTITY, PRICE
+from db.fields import USER_ID, POLL_PAGE, EXPANDED_ITEM, CUSTOM_STEP_ITEMS
+from services.fields import NAME, QUANTITY, PRICE, SOURCE
+
+
+PollCallback = namedtuple("PollCallback", ["receipt_id", "action", "item_id", "page"])
 
 
 class CallbackData:
-    QUANTITY = "quantity"
-    DECREMENT = "decrement"
-    INCREMENT = "increment"
-    QUANTITY_STEP = "quantity_step"
-    CLOSE_POLL = "close_poll"
+    VERSION = 1
+    FORMAT = struct.Struct(">B16sBHH")
+
+    TOGGLE_ITEM = 0
+    QUANTITY = 1
+    DECREMENT = 2
+    INCREMENT = 3
+    QUANTITY_STEP = 4
+    PAGE = 5
+    CLOSE_POLL = 6
+
+    def pack(self, receipt_id, action, item_id=0, page=0):
+        data = self.FORMAT.pack(self.VERSION, bytes.fromhex(receipt_id), action, item_id, page)
+        return base64.urlsafe_b64encode(data).decode()
+
+    def unpack(self, data):
+        try:
+            version, receipt_id, action, item_id, page = self.FORMAT.unpack(base64.urlsafe_b64decode(data))
+        except (ValueError, struct.error):
+            return None
+        if version != self.VERSION:
+            return None
+        return PollCallback(receipt_id.hex(), action, item_id, page)
 
 
 class ReplyMarkups:
@@ -20,13 +44,23 @@ class ReplyMarkups:
     NEED_CORRECTIONS = "Нужны правки"
     INCORRECT = "Все плохо"
     CLOSE_POLL = "Завершить Опрос"
+    PREVIOUS_PAGE = "«"
+    NEXT_PAGE = "»"
     DEFAULT_STEP = 1
     DEFAULT_QUANTITY = 0
-    MAX_OPTIONS = 30
+    PAGE_SIZE = 10
     MAX_OPTION_NAME_LEN = 25
 
     def __init__(self):
         self.callback_data = CallbackData()
+        self._poll_handlers = {
+            self.callback_data.TOGGLE_ITEM: self._toggle_item,
+            self.callback_data.DECREMENT: self._decrement_quantity,
+            self.callback_data.INCREMENT: self._increment_quantity,
+            self.callback_data.QUANTITY_STEP: self._toggle_quantity_step,
+            self.callback_data.PAGE: self._switch_page,
+            self.callback_data.CLOSE_POLL: self._collapse_item
+        }
 
     @property
     def reply_markup(self):
@@ -39,117 +73,117 @@ class ReplyMarkups:
         no_button = KeyboardButton(self.INCORRECT)
         return self.reply_markup.row(yes_button, corrections_button, no_button)
 
-    @staticmethod
-    def _form_callback(*args):
-        return ".".join(args)
-
-    @staticmethod
-    def _parse_callback(data):
-        return data.split(".")
-
-    @property
-    def close_poll(self):
+    def close_poll(self, receipt_id):
         return InlineKeyboardButton(
             text=self.CLOSE_POLL,
-            callback_data=self.callback_data.CLOSE_POLL
+            callback_data=self.callback_data.pack(receipt_id, self.callback_data.CLOSE_POLL)
         )
 
-    def inline_options(self, items, **kwargs):
-        def _set_init_option_params():
-            button.name = item[NAME]
-            button.price = item[PRICE]
-            button.total_quantity = int(item[QUANTITY])
-            button.quantity = Fraction(self.DEFAULT_QUANTITY)
-            button.default_step = Fraction(self.DEFAULT_STEP)
-            button.custom_step = Fraction(self.DEFAULT_STEP, kwargs.get(TOTAL_VOTERS_COUNT, 1))
-            button.quantity_step = button.default_step
+    def pages_count(self, items):
+        return max(math.ceil(len(items) / self.PAGE_SIZE), 1)
+
+    def option_button(self, receipt_id, item_id, item):
+        name = item[NAME][:self.MAX_OPTION_NAME_LEN]
+        if item.get(SOURCE) is not None:
+            name = "#{source} {name}".format(source=item[SOURCE], name=name)
+        price = int(item[PRICE])
+        quantity = int(item[QUANTITY])
+        text = "{name}: {price} руб, {quantity} шт.".format(name=name, price=price, quantity=quantity)
+        callback = self.callback_data.pack(receipt_id, self.callback_data.TOGGLE_ITEM, item_id=item_id)
+        return InlineKeyboardButton(text=text, callback_data=callback)
+
+    def quantity_step(self, item_id, user, total_voters_count):
+        if item_id in user[CUSTOM_STEP_ITEMS]:
+            return Fraction(self.DEFAULT_STEP, total_voters_count or 1)
+        return Fraction(self.DEFAULT_STEP)
+
+    def set_option_quantity(self, receipt_id, item_id, quantity, quantity_step):
+        def _button(text, action):
+            return InlineKeyboardButton(
+                text=text, callback_data=self.callback_data.pack(receipt_id, action, item_id=item_id)
+            )
 
-        inline_markup = InlineKeyboardMarkup()
-        items = items[:self.MAX_OPTIONS]
-        for index, item in enumerate(items):
-            name = item[NAME][:self.MAX_OPTION_NAME_LEN]
-            # price = int(item["price"] / int(item["quantity"]))
-            price = int(item[PRICE])
-            quantity = int(item[QUANTITY])
-            text = "{name}: {price} руб, {quantity} шт.".format(name=name, price=price, quantity=quantity)
-            button = InlineKeyboardButton(
-                text=text,
-                callback_data=self._form_callback(str(index))
+        return [
+            _button("-", self.callback_data.DECREMENT),
+            _button(str(quantity), self.callback_data.QUANTITY),
+            _button("+", self.callback_data.INCREMENT),
+            _button("шаг: {}".format(quantity_step), self.callback_data.QUANTITY_STEP)
+        ]
+
+    def page_navigation_row(self, receipt_id, page, pages_count):
+        def _button(text, target_page):
+            return InlineKeyboardButton(
+                text=text, callback_data=self.callback_data.pack(receipt_id, self.callback_data.PAGE, page=target_page)
             )
-            _set_init_option_params()
-            inline_markup.add(button)
-
-        return inline_markup.add(self.close_poll)
-
-    def set_option_quantity(self, item_id, option):
-        quantity_choice_row = list()
-        quantity_step_view = "шаг: {}".format(option.quantity_step)
-        quantity_callback = self._form_callback(str(item_id), self.callback_data.QUANTITY)
-        decrement_callback = self._form_callback(str(item_id), self.callback_data.DECREMENT)
-        increment_callback = self._form_callback(str(item_id), self.callback_data.INCREMENT)
-        step_callback = self._form_callback(str(item_id), self.callback_data.QUANTITY_STEP)
-        quantity_choice_row.append(InlineKeyboardButton(text="-", callback_data=decrement_callback))
-        quantity_choice_row.append(InlineKeyboardButton(text=str(option.quantity), callback_data=quantity_callback))
-        quantity_choice_row.append(InlineKeyboardButton(text="+", callback_data=increment_callback))
-        quantity_choice_row.append(InlineKeyboardButton(text=quantity_step_view, callback_data=step_callback))
-        return quantity_choice_row
-
-    @staticmethod
-    def remove_quantity_choice_row(markup, item_id=None):
-        markup_copy = copy(markup)
-        remove_choice_row_flag = False
-        for index, option in enumerate(markup_copy.inline_keyboard):
-            if len(option) > 1:
-                markup.inline_keyboard.pop(index)
-                if (item_id or item_id == 0) and index == item_id + 1:
-                    remove_choice_row_flag = True
-        return remove_choice_row_flag
-
-    def update_options_markup(self, callback_data, user_markup, master_markup):
-        def _quantity_step_handler():
-            if self.callback_data.QUANTITY_STEP in parsed_callback:
-                if option.quantity_step == option.default_step:
-                    option.quantity_step = option.custom_step
-                else:
-                    option.quantity_step = option.default_step
-
-        def _quantity_handler():
-            master_option = master_markup.inline_keyboard[item_id][0]
-            if self.callback_data.DECREMENT in parsed_callback:
-                if option.quantity - option.quantity_step >= 0:
-                    option.quantity -= option.quantity_step
-                    master_option.quantity -= option.quantity_step
-                else:
-                    if option.quantity > self.DEFAULT_QUANTITY:
-                        master_option.quantity -= option.quantity
-                        option.quantity = self.DEFAULT_QUANTITY
-            elif self.callback_data.INCREMENT in parsed_callback:
-                if option.quantity + option.quantity_step <= option.total_quantity:
-                    option.quantity += option.quantity_step
-                    master_option.quantity += option.quantity_step
-                else:
-                    if option.quantity < option.total_quantity:
-                        master_option.quantity += option.total_quantity - option.quantity
-                        option.quantity = option.total_quantity
-
-        if callback_data.isdigit():
-            item_id = int(callback_data)
-            flag = self.remove_quantity_choice_row(user_markup, item_id=item_id)
-            if not flag:
-                option = user_markup.inline_keyboard[item_id][0]
-                quantity_choice_row = self.set_option_quantity(item_id, option)
-                user_markup.inline_keyboard.insert(item_id + 1, quantity_choice_row)
+
+        navigation_row = list()
+        if page > 0:
+            navigation_row.append(_button(self.PREVIOUS_PAGE, page - 1))
+        navigation_row.append(_button("{page}/{count}".format(page=page + 1, count=pages_count), page))
+        if page < pages_count - 1:
+            navigation_row.append(_button(self.NEXT_PAGE, page + 1))
+        return navigation_row
+
+    def inline_options(self, receipt_id, items, settlement, user, total_voters_count=1):
+        inline_markup = InlineKeyboardMarkup()
+        page, pages_count = user[POLL_PAGE], self.pages_count(items)
+        first_item_id = page * self.PAGE_SIZE
+        for item_id in range(first_item_id, min(first_item_id + self.PAGE_SIZE, len(items))):
+            inline_markup.add(self.option_button(receipt_id, item_id, items[item_id]))
+            if item_id == user[EXPANDED_ITEM]:
+                quantity = settlement.user_claim(user[USER_ID], item_id)
+                quantity_step = self.quantity_step(item_id, user, total_voters_count)
+                inline_markup.row(*self.set_option_quantity(receipt_id, item_id, quantity, quantity_step))
+
+        if pages_count > 1:
+            inline_markup.row(*self.page_navigation_row(receipt_id, page, pages_count))
+        return inline_markup.add(self.close_poll(receipt_id))
+
+    def _toggle_item(self, callback, user, **kwargs):
+        user[EXPANDED_ITEM] = None if user[EXPANDED_ITEM] == callback.item_id else callback.item_id
+        return True
+
+    def _collapse_item(self, callback, user, **kwargs):
+        expanded = user[EXPANDED_ITEM] is not None
+        user[EXPANDED_ITEM] = None
+        return expanded
+
+    def _switch_page(self, callback, user, items, **kwargs):
+        page = min(callback.page, self.pages_count(items) - 1)
+        if page == user[POLL_PAGE]:
+            return False
+        user[POLL_PAGE], user[EXPANDED_ITEM] = page, None
+        return True
+
+    def _toggle_quantity_step(self, callback, user, **kwargs):
+        if callback.item_id in user[CUSTOM_STEP_ITEMS]:
+            user[CUSTOM_STEP_ITEMS].remove(callback.item_id)
         else:
-            if callback_data == self.callback_data.CLOSE_POLL:
-                self.remove_quantity_choice_row(user_markup)
-            else:
-                parsed_callback = self._parse_callback(callback_data)
-                item_id = int(parsed_callback[0])
-                option = user_markup.inline_keyboard[item_id][0]
-
-                _quantity_step_handler()
-                _quantity_handler()
-
-                quantity_choice_row = self.set_option_quantity(item_id, option)
-                user_markup.inline_keyboard[item_id+1] = quantity_choice_row
-        return user_markup, master_markup
+            user[CUSTOM_STEP_ITEMS].append(callback.item_id)
+        return True
+
+    def _set_quantity(self, callback, user, settlement, quantity):
+        if quantity == settlement.user_claim(user[USER_ID], callback.item_id):
+            return False
+        settlement.set_claim(user[USER_ID], callback.item_id, quantity)
+        return True
+
+    def _decrement_quantity(self, callback, user, settlement, total_voters_count, **kwargs):
+        quantity = settlement.user_claim(user[USER_ID], callback.item_id)
+        quantity_step = self.quantity_step(callback.item_id, user, total_voters_count)
+        quantity = max(quantity - quantity_step, Fraction(self.DEFAULT_QUANTITY))
+        return self._set_quantity(callback, user, settlement, quantity)
+
+    def _increment_quantity(self, callback, user, settlement, items, total_voters_count, **kwargs):
+        quantity = settlement.user_claim(user[USER_ID], callback.item_id)
+        quantity_step = self.quantity_step(callback.item_id, user, total_voters_count)
+        quantity = min(quantity + quantity_step, int(items[callback.item_id][QUANTITY]))
+        return self._set_quantity(callback, user, settlement, quantity)
+
+    def update_poll_state(self, callback, user, settlement, items, total_voters_count=1):
+        handler = self._poll_handlers.get(callback.action)
+        if handler is None or callback.item_id >= len(items):
+            return False
+        return handler(
+            callback, user, settlement=settlement, items=items, total_voters_count=total_voters_count
+        )
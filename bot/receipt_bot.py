@@ -1,20 +1,30 @@
 import os
 import re
+import math
 import uuid
 import time
-import pickle
+import asyncio
 
 from aiogram import types
 from aiogram.utils import deep_linking
+from aiogram.utils.exceptions import TelegramAPIError
 
 from utils.logger import behavior_log
+from utils.metrics import stage_timer, MetricsServer, Readiness, DUPLICATE_UPDATES
+from utils.profiler import Profiler
 from services.qr_parser import QRParser
 from services.img_parser import ImageParser
-from bot_config import INPUT_FOLDER
-from services.fields import NAME, PRICE, QUANTITY
-from db.db_connectors import ReceiptsDBConnector
+from services.scratch_storage import ScratchStorage
+from services.scheduler import FairScheduler, Rejected
+from services.items_combiner import ItemsCombiner
+from services.settlement import Settlement
+from services.ledger import Ledger
+from bot_config import METRICS_HOST, METRICS_PORT, ADMIN_IDS
+from services.fields import NAME, PRICE, QUANTITY, SOURCE
+from db.db_connectors import ReceiptsDBConnector, RedisConnector
 from db.fields import *
 from .keyboard import ReplyMarkups
+from .deduplication import UpdateDeduplicator
 
 
 class UserState:
@@ -29,16 +39,118 @@ class UserState:
 class ReceiptBot:
     DEEP_LINK_TRIGGER = "receipt"
     RAW_ITEM_PATTERN = "{position}. {name}:\n количество={quantity}, сумма={price}\n"
-    RAW_ITEM_REGEXP = "([а-яА-ЯёЁa-zA-Z].+)\s количество=(\d{1,2}), сумма=(\d{1,5}.\d{1,2})"
-
-    def __init__(self, dispatcher):
+    RAW_SOURCE_PATTERN = "Фото {source}:\n"
+    RAW_SOURCE_REGEXP = "Фото (\d+):"
+    RAW_ITEM_REGEXP = "([а-яА-ЯёЁa-zA-Z].+)\s количество=(\d{1,2}), сумма=(\d{1,5}[.,]\d{1,2})"
+    POLL_PATTERN = "Выберите нужные позиции в чеке \n" \
+                   "Для общих позиций нажмите на 'шаг' чтобы сделать его дробным\n\n" \
+                   "Ваша доля: {share:.2f} руб\n" \
+                   "Не распределено: {unclaimed:.2f} из {total:.2f} руб"
+    ALBUM_PROGRESS_PATTERN = "Распознано фото: {done} из {total}"
+    RATE_LIMITED_PATTERN = "Слишком много чеков подряд, попробуйте через {seconds} с"
+    OVERLOADED_TEXT = "Бот сейчас перегружен, попробуйте через пару минут"
+    ALBUM_DEBOUNCE = 1.5
+    TRANSFER_PATTERN = "{debtor} → {creditor}: {amount:.2f} руб\n"
+    SLOW_CALLBACK_PATTERN = "{callback}: {count} раз, макс. {max:.3f} с, всего {total:.3f} с\n"
+    PROFILE_TOP_CALLBACKS = 10
+    MONGO, FTS, OCR, REDIS = "mongo", "fts", "ocr", "redis"
+    # a full album of 10 photos fits into the burst, then one photo per 6 seconds
+    OCR_RATE, OCR_BURST, OCR_MAX_QUEUED = 1 / 6, 10, 50
+    FTS_CONCURRENCY, FTS_RATE, FTS_BURST, FTS_MAX_QUEUED = 4, 1 / 10, 3, 20
+    PHOTO_KEY_PATTERN = "photo:{chat_id}:{photo_id}"
+    PHOTO_DEDUP_TTL = 10 * 60
+
+    def __init__(self, dispatcher, db=None, qr_parser=None, img_parser=None, dedup_store=None):
         self._bot = dispatcher.bot
-        self._db = ReceiptsDBConnector()
-        self.qr_parser = QRParser()
-        self.img_parser = ImageParser()
+        self._db = db or ReceiptsDBConnector()
+        self.dedup_store = dedup_store or RedisConnector()
+        self.qr_parser = qr_parser or QRParser()
+        self.img_parser = img_parser or ImageParser()
+        self.items_combiner = ItemsCombiner()
         self.state = UserState()
         self.markup = ReplyMarkups()
-        behavior_log("Init {bot}".format(bot=type(self).__name__))
+        self.readiness = Readiness(self.MONGO, self.FTS, self.OCR, self.REDIS)
+        self.profiler = Profiler()
+        self.admin_ids = set(filter(None, os.getenv(ADMIN_IDS, "").split(",")))
+        self.metrics_server = MetricsServer(
+            host=METRICS_HOST, port=METRICS_PORT, readiness=self.readiness, profiler=self.profiler
+        )
+        self.ocr_scheduler = FairScheduler(
+            self.OCR, concurrency=self.img_parser.OCR_WORKERS,
+            rate=self.OCR_RATE, burst=self.OCR_BURST, max_queued=self.OCR_MAX_QUEUED
+        )
+        self.fts_scheduler = FairScheduler(
+            self.FTS, concurrency=self.FTS_CONCURRENCY,
+            rate=self.FTS_RATE, burst=self.FTS_BURST, max_queued=self.FTS_MAX_QUEUED
+        )
+        self._albums = dict()
+        self._startup_tasks = list()
+        behavior_log("Init {bot}", bot=type(self).__name__)
+
+    def register_handlers(self, dispatcher):
+        dispatcher.middleware.setup(UpdateDeduplicator(self.dedup_store))
+        dispatcher.register_message_handler(self.start_inline_poll, lambda message: self.check_deeplink(message.text))
+        dispatcher.register_message_handler(self.start_message, commands=["start"])
+        dispatcher.register_message_handler(self.send_balance, commands=["balance"])
+        dispatcher.register_message_handler(
+            self.run_profiler, lambda message: str(message.from_user.id) in self.admin_ids, commands=["profile"]
+        )
+        dispatcher.register_message_handler(
+            self.parse_receipt_qr_and_send_poll, lambda message: self.check_qr_code(message.text)
+        )
+        dispatcher.register_message_handler(
+            self.collect_album_photo, lambda message: message.media_group_id is not None, content_types=["photo"]
+        )
+        dispatcher.register_message_handler(self.parse_receipt_image_and_send_poll, content_types=["photo"])
+        dispatcher.register_callback_query_handler(self.inline_poll_handler)
+
+        dispatcher.register_message_handler(
+            self.raw_items_validation, lambda message: self.state_handler(message, state_id=self.state.ITEMS_VALIDATION)
+        )
+        dispatcher.register_message_handler(
+            self.raw_items_correction, lambda message: self.state_handler(message, state_id=self.state.ITEMS_CORRECTION)
+        )
+        dispatcher.register_message_handler(
+            self.create_start_deeplink,
+            lambda message: self.state_handler(message, state_id=self.state.ENTER_VOTERS_COUNT)
+        )
+
+    async def initialize_component(self, component, initializer):
+        try:
+            with stage_timer("startup", component=component):
+                await initializer()
+        except Exception as e:
+            self.readiness.set_failed(component, e)
+            behavior_log("Failed to initialize {component}", level="ERROR", exc_info=True, component=component)
+        else:
+            self.readiness.set_ready(component)
+            behavior_log("Component {component} is ready", component=component)
+
+    async def prepare_db(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._db.prepare)
+
+    async def authenticate_fts(self):
+        if not await asyncio.get_running_loop().run_in_executor(None, self.qr_parser.authenticate):
+            raise ConnectionError("Federal tax service authentication failed")
+
+    async def check_dedup_store(self):
+        if not await asyncio.get_running_loop().run_in_executor(None, self.dedup_store.is_available):
+            raise ConnectionError("Redis is unavailable, updates are deduplicated in memory")
+
+    async def on_startup(self, dispatcher):
+        await self.metrics_server.start()
+        await self.initialize_component(self.MONGO, self.prepare_db)
+        self._startup_tasks = [
+            asyncio.create_task(self.initialize_component(self.FTS, self.authenticate_fts)),
+            asyncio.create_task(self.initialize_component(self.OCR, self.img_parser.warm_up)),
+            asyncio.create_task(self.initialize_component(self.REDIS, self.check_dedup_store))
+        ]
+
+    async def on_shutdown(self, dispatcher):
+        for task in self._startup_tasks:
+            task.cancel()
+        await self.metrics_server.stop()
+        self.img_parser.close()
 
     @staticmethod
     def check_qr_code(text):
@@ -52,16 +164,21 @@ class ReceiptBot:
         current_state_id = self._db.get_dialog_state(chat_id)
         return current_state_id == state_id
 
+    def is_validated_receipt(self, chat_id, receipt_id):
+        receipt = self._db.get_receipt_by_state(chat_id=chat_id, state_id=self.state.ITEMS_VALIDATION)
+        return receipt.get(RECEIPT_ID) == receipt_id
+
     @staticmethod
     def composite_key(*args):
         return ".".join(args)
 
     @staticmethod
-    def unpickle_markup(markup):
-        if isinstance(markup, bytes):
-            return pickle.loads(markup)
-        else:
-            return markup
+    def settlement(receipt):
+        return Settlement(
+            receipt[CLEAN_ITEMS], receipt[TOTAL_VOTERS_COUNT], scale=receipt[VALUE_SCALE],
+            total_value=receipt[TOTAL_VALUE], claimed_value=receipt[CLAIMED_VALUE],
+            claims=receipt[CLAIMS], claimed_units=receipt[CLAIMED_UNITS], user_totals=receipt[USER_TOTALS]
+        )
 
     @staticmethod
     async def start_message(message: types.Message):
@@ -76,40 +193,188 @@ class ReceiptBot:
             receipt_document[key] = value
         return receipt_document
 
-    def _get_user_document(self, user_id, markup):
+    def _get_user_document(self, user_id):
         user = self._db.user
         user[USER_ID] = user_id
-        user[OPTIONS_MARKUP] = pickle.dumps(markup)
         return user
 
-    async def parse_receipt_image_and_send_poll(self, message: types.Message):
-        image = message.photo[-1]
+    async def download_photo(self, message: types.Message, job):
+        image = self.img_parser.choose_photo_size(message.photo)
         image_name = image.file_unique_id + ".jpg"
-        path_to_image = os.path.join(INPUT_FOLDER, image_name)
-        behavior_log("User: {user}, Trying to fetch receipt image {name}".format(user=message.chat.id, name=image_name))
-        await image.download(path_to_image)
+        path_to_image = job.file(image_name)
+        behavior_log(
+            "User: {chat_id}, Trying to fetch receipt image {name} of size {width}x{height}",
+            chat_id=message.chat.id, name=image_name, width=image.width, height=image.height
+        )
+        with stage_timer("photo_download", chat_id=message.chat.id):
+            await image.download(path_to_image)
+        return path_to_image, {WIDTH: image.width, HEIGHT: image.height, FILE_SIZE: image.file_size}
+
+    async def admit_job(self, scheduler, message: types.Message, cost=1):
+        try:
+            scheduler.admit(message.chat.id, cost)
+        except Rejected as rejection:
+            if rejection.notify and rejection.reason == scheduler.RATE_LIMITED:
+                await message.answer(text=self.RATE_LIMITED_PATTERN.format(seconds=math.ceil(rejection.retry_after)))
+            elif rejection.notify:
+                await message.answer(text=self.OVERLOADED_TEXT)
+            return False
+        return True
+
+    async def parse_receipt_image_and_send_poll(self, message: types.Message):
+        photo_key = self.PHOTO_KEY_PATTERN.format(chat_id=message.chat.id, photo_id=message.photo[-1].file_unique_id)
+        if not self.dedup_store.set_if_absent(photo_key, message.message_id, self.PHOTO_DEDUP_TTL):
+            DUPLICATE_UPDATES.inc(kind="photo")
+            behavior_log("User: {chat_id}, Skip photo that is already recognized", chat_id=message.chat.id)
+            await message.answer(text="Это фото уже распознается или было распознано в последние 10 минут")
+            return
+
+        recognized = False
+        try:
+            if await self.admit_job(self.ocr_scheduler, message):
+                recognized = await self.ocr_scheduler.run(message.chat.id, self.parse_receipt_image, message)
+        finally:
+            if not recognized:
+                self.dedup_store.delete(photo_key)
+
+    async def parse_receipt_image(self, message: types.Message):
+        with self.img_parser.storage.job() as job:
+            recognized = await self.recognize_receipt_image(message, job)
+            if not recognized:
+                job.retain(ScratchStorage.UNRECOGNIZED)
+        return recognized
+
+    async def recognize_receipt_image(self, message: types.Message, job):
+        path_to_image, photo_size = await self.download_photo(message, job)
         await message.answer(text="Идет распознавание чека")
-        # self.img_parser.find_receipt_on_image_and_crop_it(path_to_image)
-        items = await self.img_parser.parse(image_name)
-        if len(items) == 0:
+        # await self.img_parser.find_receipt_on_image_and_crop_it(path_to_image)
+        receipt_document, items_message = None, None
+        async for items in self.img_parser.parse_progressively(path_to_image):
+            if receipt_document is None:
+                receipt_document = self.init_receipt_document(
+                    chat_id=message.chat.id,
+                    data={
+                        RAW_ITEMS: items,
+                        PHOTO_SIZES: [photo_size],
+                        DIALOG_STATE_ID: self.state.ITEMS_VALIDATION
+                    }
+                )
+                self._db.set_receipt(document=receipt_document)
+                items_message = await self.send_raw_items_for_validation(message, items)
+            elif self.is_validated_receipt(message.chat.id, receipt_document[RECEIPT_ID]):
+                behavior_log(
+                    "User: {chat_id}, Update raw items with better recognition result",
+                    chat_id=message.chat.id, receipt_id=receipt_document[RECEIPT_ID]
+                )
+                self._db.update_receipt_by_id(
+                    receipt_id=receipt_document[RECEIPT_ID],
+                    update={
+                        RAW_ITEMS: items,
+                        ACCESS_TIMESTAMP: time.time()
+                    }
+                )
+                await self._bot.edit_message_text(
+                    text=self.format_raw_items(items),
+                    chat_id=items_message.chat.id,
+                    message_id=items_message.message_id
+                )
+
+        if receipt_document is None:
             await self._bot.send_message(
                 chat_id=message.chat.id,
                 text="Не удалось распознать чек :( \n"
                      "Сфотографируйте его как можно ближе и без вспышки"
             )
-        else:
-            receipt_document = self.init_receipt_document(
-                chat_id=message.chat.id,
-                data={
-                    RAW_ITEMS: items,
-                    DIALOG_STATE_ID: self.state.ITEMS_VALIDATION
-                }
+        return receipt_document is not None
+
+    async def collect_album_photo(self, message: types.Message):
+        album = self._albums.get(message.media_group_id)
+        if album is not None:
+            album.append(message)
+            return
+
+        album = self._albums[message.media_group_id] = [message]
+        photos_count = 0
+        while photos_count != len(album):
+            photos_count = len(album)
+            await asyncio.sleep(self.ALBUM_DEBOUNCE)
+        del self._albums[message.media_group_id]
+        await self.parse_receipt_album_and_send_poll(sorted(album, key=lambda album_message: album_message.message_id))
+
+    async def parse_album_photo(self, source, message: types.Message):
+        items, photo_size = [], None
+        with self.img_parser.storage.job() as job:
+            try:
+                path_to_image, photo_size = await self.download_photo(message, job)
+                items = await self.img_parser.parse(path_to_image)
+            except Exception:
+                job.retain(ScratchStorage.FAILED)
+                behavior_log(
+                    "User: {chat_id}, Failed to parse album photo {source}", level="ERROR", exc_info=True,
+                    chat_id=message.chat.id, source=source
+                )
+            else:
+                if not items:
+                    job.retain(ScratchStorage.UNRECOGNIZED)
+        for item in items:
+            item[SOURCE] = source
+        return source, items, photo_size
+
+    async def parse_receipt_album_and_send_poll(self, messages):
+        message = messages[0]
+        if not await self.admit_job(self.ocr_scheduler, message, cost=len(messages)):
+            return
+        behavior_log(
+            "User: {chat_id}, Start parsing album of {count} photos", chat_id=message.chat.id, count=len(messages)
+        )
+        progress_message = await message.answer(
+            text=self.ALBUM_PROGRESS_PATTERN.format(done=0, total=len(messages))
+        )
+
+        photos_items, photo_sizes, failed_sources = dict(), dict(), list()
+        with stage_timer("album_parsing", chat_id=message.chat.id, count=len(messages)):
+            parsing_tasks = [
+                self.ocr_scheduler.run(message.chat.id, self.parse_album_photo, source, album_message)
+                for source, album_message in enumerate(messages, start=1)
+            ]
+            for done, parsing_task in enumerate(asyncio.as_completed(parsing_tasks), start=1):
+                source, items, photo_sizes[source] = await parsing_task
+                if items:
+                    photos_items[source] = items
+                else:
+                    failed_sources.append(source)
+                await self._bot.edit_message_text(
+                    text=self.ALBUM_PROGRESS_PATTERN.format(done=done, total=len(messages)),
+                    chat_id=progress_message.chat.id,
+                    message_id=progress_message.message_id
+                )
+
+        if failed_sources:
+            await message.answer(
+                text="Не удалось распознать фото: {}".format(", ".join(map(str, sorted(failed_sources))))
             )
-            self._db.set_receipt(document=receipt_document)
-            await self.send_raw_items_for_validation(message, items)
+        if not photos_items:
+            await message.answer(text="Сфотографируйте чеки как можно ближе и без вспышки")
+            return
+
+        items = [item for source in sorted(photos_items) for item in photos_items[source]]
+        receipt_document = self.init_receipt_document(
+            chat_id=message.chat.id,
+            data={
+                RAW_ITEMS: items,
+                PHOTO_SIZES: [photo_sizes[source] for source in sorted(photo_sizes)],
+                DIALOG_STATE_ID: self.state.ITEMS_VALIDATION
+            }
+        )
+        self._db.set_receipt(document=receipt_document)
+        await self.send_raw_items_for_validation(message, items)
 
     async def parse_receipt_qr_and_send_poll(self, message: types.Message):
-        behavior_log("User: {user}, Start parsing qr code {code}".format(user=message.chat.id, code=message.text))
+        if await self.admit_job(self.fts_scheduler, message):
+            await self.fts_scheduler.run(message.chat.id, self.parse_receipt_qr, message)
+
+    async def parse_receipt_qr(self, message: types.Message):
+        behavior_log("User: {chat_id}, Start parsing qr code {code}", chat_id=message.chat.id, code=message.text)
         items = await self.qr_parser.get_ticket_items(qr=message.text)
         if len(items) == 0:
             await self._bot.send_message(
@@ -120,19 +385,25 @@ class ReceiptBot:
             await message.answer(text="Данные по чеку получены")
             await self.save_receipt_and_ask_for_voters_count(message, items)
 
-    async def send_raw_items_for_validation(self, message, items):
+    def format_raw_items(self, items):
         raw_items = ""
+        is_album = len({item.get(SOURCE) for item in items}) > 1
         for i, item in enumerate(items):
+            if is_album and (i == 0 or item.get(SOURCE) != items[i - 1].get(SOURCE)):
+                raw_items += self.RAW_SOURCE_PATTERN.format(source=item.get(SOURCE))
             raw_items += self.RAW_ITEM_PATTERN.format(
                 position=i, name=item[NAME], quantity=item[QUANTITY], price=item[PRICE]
             )
+        return raw_items
 
-        await message.answer(text=raw_items)
+    async def send_raw_items_for_validation(self, message, items):
+        items_message = await message.answer(text=self.format_raw_items(items))
         await self._bot.send_message(
             chat_id=message.chat.id,
             text="Проверьте, что количество и сумма распознанных элементов совпадает с чеком",
             reply_markup=self.markup.validation_markup
         )
+        return items_message
 
     async def raw_items_validation(self, message: types.Message):
         receipt = self._db.get_receipt_by_state(
@@ -159,189 +430,317 @@ class ReceiptBot:
             await message.answer(text="Воспользуйтесь кнопками")
 
     async def raw_items_correction(self, message: types.Message):
-        corrected_items = []
-        corrected_raw_items = re.split("\n\d\. ", message.text)
+        corrected_items, source = [], None
+        corrected_raw_items = re.split("\n\d+\. ", message.text)
         for corrected_raw_item in corrected_raw_items:
             result = re.search(self.RAW_ITEM_REGEXP, corrected_raw_item)
-            attrs = self.img_parser.get_item_attrs(result)
-            corrected_item = self.img_parser.set_item_attrs(*attrs)
-            corrected_items.append(corrected_item)
+            if result is not None:
+                attrs = self.img_parser.get_item_attrs(result)
+                corrected_item = self.img_parser.set_item_attrs(*attrs)
+                if corrected_item is None:
+                    await message.answer(
+                        text="Не удалось разобрать позицию:\n{}\nИсправьте ее и перешлите чек еще раз".format(
+                            corrected_raw_item[:result.end()].strip()
+                        )
+                    )
+                    return
+                if source is not None:
+                    corrected_item[SOURCE] = source
+                corrected_items.append(corrected_item)
+
+            source_header = re.search(self.RAW_SOURCE_REGEXP, corrected_raw_item[result.end() if result else 0:])
+            if source_header is not None:
+                source = int(source_header.group(1))
 
         await self.save_receipt_and_ask_for_voters_count(
             message=message,
             items=corrected_items
         )
 
-    @staticmethod
-    def combine_identical_items(items):
-        words_pool = set()
-        combined_items = {}
-        for item in items:
-            name, price = item.get(NAME), item.get(PRICE)
-            cleaned_name = set([word for word in name.split() if len(word) > 1])
-            if words_pool.intersection(name.split()):
-                combine_flag = False
-                for comb_name, comb_item in combined_items.items():
-                    if cleaned_name.intersection(comb_name.split()) and comb_item[PRICE] == price:
-                        combined_items[comb_name][QUANTITY] += 1
-                        combine_flag = True
-                        break
-                if not combine_flag:
-                    combined_items.update({name: item})
-            else:
-                combined_items.update({name: item})
-
-            words_pool.update(cleaned_name)
-        return list(combined_items.values())
+    def combine_identical_items(self, items):
+        with stage_timer("combine_items", count=len(items)):
+            return self.items_combiner.combine(items)
 
     async def save_receipt_and_ask_for_voters_count(self, message, items):
         combined_items = self.combine_identical_items(items)
-        inline_markup = self.markup.inline_options(combined_items)
         receipt_document = self.init_receipt_document(
             chat_id=message.chat.id,
             data={
                 CLEAN_ITEMS: combined_items,
                 DIALOG_STATE_ID: self.state.ENTER_VOTERS_COUNT,
-                RECEIPT_MARKUP: pickle.dumps(inline_markup)
+                PAYER_ID: str(message.from_user.id),
+                PAYER_NAME: message.from_user.full_name
             }
         )
         self._db.set_receipt(document=receipt_document)
         await message.answer(text="На скольких человек делим чек?")
 
     async def create_start_deeplink(self, message: types.Message):
-        behavior_log("User: {user}, Creating receipt deeplink".format(user=message.chat.id))
+        behavior_log("User: {chat_id}, Creating receipt deeplink", chat_id=message.chat.id)
         receipt = self._db.get_receipt_by_state(
             chat_id=message.chat.id,
             state_id=self.state.ENTER_VOTERS_COUNT
         )
+        settlement = Settlement(receipt[CLEAN_ITEMS], int(message.text))
         self._db.update_receipt_by_id(
             receipt_id=receipt[RECEIPT_ID],
             update={
                 TOTAL_VOTERS_COUNT: int(message.text),
+                VALUE_SCALE: settlement.scale,
+                TOTAL_VALUE: settlement.total_value,
                 DIALOG_STATE_ID: self.state.USERS_VOTE,
                 ACCESS_TIMESTAMP: time.time()
             }
         )
         link = await deep_linking.get_start_link(payload=self.DEEP_LINK_TRIGGER + receipt[RECEIPT_ID])
         await message.answer(text=link)
-        behavior_log("User: {user}, Send created deeplink: {link}".format(user=message.chat.id, link=link))
+        behavior_log(
+            "User: {chat_id}, Send created deeplink: {link}",
+            chat_id=message.chat.id, receipt_id=receipt[RECEIPT_ID], link=link
+        )
         await message.answer(text="Скопируйте ссылку на опрос и отправьте друзьям")
 
     async def start_inline_poll(self, message: types.Message):
         user_id = str(message.from_user.id)
         receipt_id = message.text.replace("/start {}".format(self.DEEP_LINK_TRIGGER), "")
-        behavior_log("User: {user}, Start poll by deeplink: receipt {id}".format(user=message.chat.id, id=receipt_id))
-        receipt = self._db.get_receipt(keys={RECEIPT_ID: receipt_id})
-
-        behavior_log("User: {user}, Set inline poll for user".format(user=message.chat.id))
+        behavior_log(
+            "User: {chat_id}, Start poll by deeplink: receipt {receipt_id}", chat_id=message.chat.id, receipt_id=receipt_id
+        )
+        receipt = self._db.get_receipt(keys={RECEIPT_ID: receipt_id, DIALOG_STATE_ID: self.state.USERS_VOTE})
+        if not receipt or user_id in receipt[CLOSED_USERS]:
+            await message.answer(text="Опрос завершен или недоступен")
+            return
+
+        behavior_log("User: {chat_id}, Set inline poll for user", chat_id=message.chat.id, receipt_id=receipt_id)
+        user = receipt[USERS].get(user_id) or self._get_user_document(user_id)
+        user[USER_NAME] = message.from_user.full_name
+        settlement = self.settlement(receipt)
         inline_markup = self.markup.inline_options(
+            receipt_id=receipt[RECEIPT_ID],
             items=receipt[CLEAN_ITEMS],
+            settlement=settlement,
+            user=user,
             total_voters_count=receipt[TOTAL_VOTERS_COUNT]
         )
         self._db.update_receipt_by_id(
             receipt_id=receipt[RECEIPT_ID],
             update={
-                self.composite_key(USERS, user_id): self._get_user_document(user_id, inline_markup),
+                self.composite_key(USERS, user_id): user,
                 ACCESS_TIMESTAMP: time.time()
             }
         )
-        behavior_log("User: {user}, Sending inline poll".format(user=message.chat.id))
+        behavior_log("User: {chat_id}, Sending inline poll", chat_id=message.chat.id, receipt_id=receipt_id)
         await self._bot.send_message(
             chat_id=message.chat.id,
-            text="Выберите нужные позиции в чеке \nДля общих позиций нажмите на 'шаг' чтобы сделать его дробным",
+            text=self.poll_text(settlement, user_id),
             reply_markup=inline_markup
         )
 
     async def inline_poll_handler(self, callback_query: types.CallbackQuery):
         user_id = str(callback_query.from_user.id)
-        behavior_log("User: {user}, Inline poll callback handle".format(user=user_id))
+        behavior_log("User: {user_id}, Inline poll callback handle", level="DEBUG", user_id=user_id)
+
+        poll_callback = self.markup.callback_data.unpack(callback_query.data)
+        if poll_callback is None:
+            await self._bot.answer_callback_query(callback_query.id, text="Опрос устарел")
+            return
 
         receipt = self._db.get_receipt(
             keys={
-                self.composite_key(USERS, user_id, USER_ID): user_id,
+                RECEIPT_ID: poll_callback.receipt_id,
                 DIALOG_STATE_ID: self.state.USERS_VOTE
-            },
-            sort=[(ACCESS_TIMESTAMP, -1)]
+            }
         )
-        pickled_markup = receipt[USERS][user_id][OPTIONS_MARKUP]
-        user_markup = self.unpickle_markup(pickled_markup)
-        await self.edit_inline_poll(callback_query, user_markup, receipt)
+        if user_id not in receipt.get(USERS, {}):
+            await self._bot.answer_callback_query(callback_query.id, text="Опрос завершен или недоступен")
+            return
+        if user_id in receipt[CLOSED_USERS]:
+            await self._bot.answer_callback_query(callback_query.id, text="Вы уже завершили опрос")
+            return
+
+        await self.edit_inline_poll(callback_query, poll_callback, receipt)
 
-        if callback_query.data == self.markup.callback_data.CLOSE_POLL:
+        if poll_callback.action == self.markup.callback_data.CLOSE_POLL:
             await self.close_inline_poll(callback_query, receipt)
 
-    async def edit_inline_poll(self, callback, user_markup, receipt):
+    async def edit_inline_poll(self, callback, poll_callback, receipt):
         user_id = str(callback.from_user.id)
-        behavior_log("User: {user}, Edit poll with callback {data}".format(user=user_id, data=callback.data))
+        behavior_log(
+            "User: {user_id}, Edit poll with callback {data}", level="DEBUG",
+            user_id=user_id, receipt_id=receipt[RECEIPT_ID], data=poll_callback
+        )
 
-        updated_user_markup, updated_master_markup = self.markup.update_options_markup(
-            callback_data=callback.data,
-            master_markup=self.unpickle_markup(receipt[RECEIPT_MARKUP]),
-            user_markup=user_markup
+        settlement = self.settlement(receipt)
+        user = receipt[USERS][user_id]
+        is_updated = self.markup.update_poll_state(
+            callback=poll_callback,
+            user=user,
+            settlement=settlement,
+            items=receipt[CLEAN_ITEMS],
+            total_voters_count=receipt[TOTAL_VOTERS_COUNT]
         )
-        self._db.update_receipt_by_id(
+        if not is_updated:
+            await self._bot.answer_callback_query(callback.id)
+            return
+
+        if not settlement.changes:
+            self._db.update_receipt_by_id(
+                receipt_id=receipt[RECEIPT_ID],
+                update={
+                    self.composite_key(USERS, user_id): user,
+                    ACCESS_TIMESTAMP: time.time()
+                }
+            )
+        else:
+            receipt = self._db.update_user_claim(
+                receipt_id=receipt[RECEIPT_ID], user=user, change=settlement.changes[-1]
+            )
+            if receipt is None:
+                await self._bot.answer_callback_query(callback.id, text="Опрос изменился, попробуйте еще раз")
+                return
+            settlement = self.settlement(receipt)
+
+        updated_user_markup = self.markup.inline_options(
             receipt_id=receipt[RECEIPT_ID],
-            update={
-                self.composite_key(USERS, user_id, OPTIONS_MARKUP): updated_user_markup,
-                RECEIPT_MARKUP: updated_master_markup,
-                ACCESS_TIMESTAMP: time.time()
-            }
+            items=receipt[CLEAN_ITEMS],
+            settlement=settlement,
+            user=user,
+            total_voters_count=receipt[TOTAL_VOTERS_COUNT]
         )
         await self._bot.answer_callback_query(callback.id)
-        await self._edit_inline_poll(callback, updated_user_markup)
+        await self._edit_inline_poll(callback, updated_user_markup, self.poll_text(settlement, user_id))
 
-    async def _edit_inline_poll(self, callback, updated_markup):
+    def poll_text(self, settlement, user_id):
+        return self.POLL_PATTERN.format(
+            share=float(settlement.user_share(user_id)),
+            unclaimed=float(settlement.unclaimed_total),
+            total=float(settlement.total)
+        )
+
+    async def _edit_inline_poll(self, callback, updated_markup, text):
         return await self._bot.edit_message_text(
-            text=callback.message.text,
+            text=text,
             chat_id=callback.from_user.id,
             message_id=callback.message.message_id,
             reply_markup=updated_markup
         )
 
     async def close_inline_poll(self, callback, receipt):
-        voters_count = receipt[VOTERS_COUNT] + 1
-        behavior_log("User: {user}, Closing poll".format(user=callback.from_user.id))
+        behavior_log("User: {user_id}, Closing poll", user_id=callback.from_user.id, receipt_id=receipt[RECEIPT_ID])
+        voters_count = self._db.close_user_vote(receipt_id=receipt[RECEIPT_ID], user_id=str(callback.from_user.id))
+        if voters_count is None:
+            DUPLICATE_UPDATES.inc(kind="close_poll")
+            behavior_log("User: {user_id}, Poll is already closed", user_id=callback.from_user.id,
+                         receipt_id=receipt[RECEIPT_ID])
+            return
 
-        self._db.update_receipt_by_id(
-            receipt_id=receipt[RECEIPT_ID],
-            update={
-                VOTERS_COUNT: voters_count,
-                ACCESS_TIMESTAMP: time.time()
-            }
-        )
-        await self._bot.answer_callback_query(callback.id)
         await self._bot.send_message(
             chat_id=callback.message.chat.id,
             text="Спасибо! Ожидате окончания голосования"
         )
-        if voters_count == receipt[TOTAL_VOTERS_COUNT]:
+        if voters_count >= receipt[TOTAL_VOTERS_COUNT] and self._db.mark_receipt_closed(
+                receipt_id=receipt[RECEIPT_ID], state_id=self.state.CLOSED
+        ):
             await self.close_receipt(receipt_id=receipt[RECEIPT_ID])
 
     async def close_receipt(self, receipt_id):
-        behavior_log("Closing receipt: {id}".format(id=receipt_id))
+        behavior_log("Closing receipt: {receipt_id}", receipt_id=receipt_id)
         receipt = self._db.get_receipt(keys={RECEIPT_ID: receipt_id})
 
-        debt_results = self.debt_calculations(receipt)
-        for user_id, debt in debt_results.items():
-            behavior_log("User: {user}, Send debt to user: sum = {debt}".format(user=user_id, debt=debt))
-            await self._bot.send_message(
-                chat_id=user_id,
-                text="Опрос окончен! \n"
-                     "Ваш долг по чеку составляет {:.2f} руб".format(debt)
+        with stage_timer("debt_calculations", receipt_id=receipt_id):
+            debt_results = self.debt_calculations(receipt)
+        self.record_receipt_in_ledger(receipt, debt_results)
+        for user_id, debt_kopecks in debt_results.items():
+            debt = debt_kopecks / Settlement.KOPECKS_IN_RUBLE
+            behavior_log(
+                "User: {user_id}, Send debt to user: sum = {debt}", user_id=user_id, receipt_id=receipt_id, debt=debt
             )
+            try:
+                await self._bot.send_message(
+                    chat_id=user_id,
+                    text="Опрос окончен! \n"
+                         "Ваш долг по чеку составляет {:.2f} руб".format(debt)
+                )
+            except TelegramAPIError:
+                behavior_log(
+                    "User: {user_id}, Failed to send debt", level="ERROR", exc_info=True,
+                    user_id=user_id, receipt_id=receipt_id
+                )
+        try:
+            await self.send_unclaimed_items(receipt)
+        except TelegramAPIError:
+            behavior_log("Receipt: {receipt_id}, Failed to send unclaimed items", level="ERROR", exc_info=True,
+                         receipt_id=receipt_id)
+
+    async def run_profiler(self, message: types.Message):
+        args = message.get_args()
+        duration = int(args) if args and args.isdigit() else Profiler.DEFAULT_DURATION
+        if self.profiler.is_running:
+            await message.answer(text="Профилирование уже запущено")
+            return
+
+        await message.answer(text="Профилирование запущено на {} с".format(min(duration, Profiler.MAX_DURATION)))
+        report = await self.profiler.profile(duration)
+        slow_callbacks_view = ""
+        for callback in report["slow_callbacks"][:self.PROFILE_TOP_CALLBACKS]:
+            slow_callbacks_view += self.SLOW_CALLBACK_PATTERN.format(**callback)
+        await message.answer(
+            text="Сэмплов: {samples}, профиль: {flamegraph}\n".format(**report) +
+                 (slow_callbacks_view or "Блокировок цикла событий не найдено")
+        )
+
+    def record_receipt_in_ledger(self, receipt, debts):
+        names = {user_id: user.get(USER_NAME) for user_id, user in receipt[USERS].items() if user.get(USER_NAME)}
+        if receipt[PAYER_NAME]:
+            names[receipt[PAYER_ID]] = receipt[PAYER_NAME]
+        recorded = self._db.record_settlement(
+            entry={
+                CHAT_ID: receipt[CHAT_ID],
+                RECEIPT_ID: receipt[RECEIPT_ID],
+                PAYER_ID: receipt[PAYER_ID],
+                DEBTS: debts,
+                CLOSE_TIMESTAMP: time.time()
+            },
+            changes=Ledger.receipt_changes(receipt[PAYER_ID], debts),
+            names=names
+        )
+        if recorded:
+            behavior_log("Receipt: {receipt_id}, Recorded in ledger of chat {chat_id}",
+                         receipt_id=receipt[RECEIPT_ID], chat_id=receipt[CHAT_ID])
+
+    async def send_balance(self, message: types.Message):
+        balances = self._db.get_balances(chat_id=message.chat.id)
+        with stage_timer("ledger_transfers", chat_id=message.chat.id):
+            transfers = Ledger(balances.get(BALANCES, {})).transfers()
+        if not transfers:
+            await message.answer(text="Все долги погашены")
+            return
+
+        names = balances.get(USER_NAME, {})
+        transfers_view = ""
+        for debtor, creditor, amount in transfers:
+            transfers_view += self.TRANSFER_PATTERN.format(
+                debtor=names.get(debtor, debtor),
+                creditor=names.get(creditor, creditor),
+                amount=amount / Settlement.KOPECKS_IN_RUBLE
+            )
+        await message.answer(text="Кто кому должен по всем чекам:\n" + transfers_view)
+
+    async def send_unclaimed_items(self, receipt):
+        settlement = self.settlement(receipt)
+        unclaimed_items = settlement.unclaimed_items()
+        if not unclaimed_items:
+            return
+
+        behavior_log("Receipt: {receipt_id}, Unclaimed items: {items}", receipt_id=receipt[RECEIPT_ID], items=unclaimed_items)
+        unclaimed_view = ""
+        for item_id, quantity in unclaimed_items.items():
+            unclaimed_view += "{name}: {quantity} шт.\n".format(name=receipt[CLEAN_ITEMS][item_id][NAME], quantity=quantity)
+        await self._bot.send_message(
+            chat_id=receipt[CHAT_ID],
+            text="Никто не выбрал позиции на {:.2f} руб: \n".format(float(settlement.unclaimed_total)) + unclaimed_view
+        )
 
     def debt_calculations(self, receipt):
-        users_debt_map = {}
-        users = receipt[USERS]
-        master_markup = self.unpickle_markup(receipt[RECEIPT_MARKUP])
-        for user_id, user in users.items():
-            user_markup = self.unpickle_markup(user[OPTIONS_MARKUP])
-            if user_id not in users_debt_map:
-                users_debt_map[user_id] = 0
-
-            for option_id, option in enumerate(user_markup.inline_keyboard):
-                option = option[0]
-                if hasattr(option, QUANTITY) and option.quantity > 0:
-                    voters_quantity = master_markup.inline_keyboard[option_id][0].quantity
-                    users_debt_map[user_id] += option.price / voters_quantity
-        return users_debt_map
+        debts = self.settlement(receipt).debts()
+        return {user_id: debts.get(user_id, 0) for user_id in receipt[USERS]}
@@ -5,11 +5,14 @@ import yaml
 BASE_PATH = os.getcwd()
 CONNECT_TIMEOUT, READ_TIMEOUT = 5, 10
 LOGGER_NAME = "behavior_logger"
+LOG_LEVEL = "BOT_LOG_LEVEL"
+METRICS_HOST, METRICS_PORT = "127.0.0.1", 9100
 
 BOT_TOKEN = "BOT_SECRET_TOKEN"
 FEDERAL_TAX_LOGIN = "FEDERAL_TAX_INN"
 FEDERAL_TAX_PASSWORD = "FEDERAL_TAX_PASSWORD"
 FEDERAL_TAX_SECRET_TOKEN = "FEDERAL_TAX_SECRET_TOKEN"
+ADMIN_IDS = "BOT_ADMIN_IDS"
 
 DATA_PATH = BASE_PATH + "/data"
 CONFIGS_PATH = BASE_PATH + "/configs"
@@ -20,6 +23,8 @@ PARSER_CONFIG_PATH = os.path.join(CONFIGS_PATH, "config.yml")
 INPUT_FOLDER = os.path.join(DATA_PATH, "img")
 TMP_FOLDER = os.path.join(DATA_PATH, "tmp")
 OUTPUT_FOLDER = os.path.join(DATA_PATH, "txt")
+SAMPLES_FOLDER = os.path.join(DATA_PATH, "samples")
+PROFILES_FOLDER = os.path.join(DATA_PATH, "profiles")
 
 
 def get_config(path):
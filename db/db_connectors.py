@@ -1,10 +1,13 @@
 import time
 import pickle
+from collections import OrderedDict
 
-from pymongo import MongoClient
-from redis import Redis
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from redis import Redis, RedisError
 
 from utils.logger import behavior_log
+from utils.metrics import MONGO_QUERY_DURATION
 from .fields import *
 
 
@@ -12,8 +15,8 @@ class MongoBase:
     URI = "mongodb://localhost:27017"
     POLL_DATABASE = "poll_db"
 
-    def __init__(self):
-        self._client = MongoClient(self.URI)
+    def __init__(self, client=None):
+        self._client = client or MongoClient(self.URI)
         self._db = self._client[self.POLL_DATABASE]
 
     @staticmethod
@@ -22,37 +25,65 @@ class MongoBase:
             return True
 
     def insert_one(self, collection, data):
-        self._db[collection].insert_one(document=data)
+        with MONGO_QUERY_DURATION.time(operation="insert_one", collection=collection):
+            self._db[collection].insert_one(document=data)
 
     def find(self, collection, query, many=False, **kwargs):
-        if many:
-            document = []
-            cursor = self._db[collection].find(filter=query, **kwargs)
-            for doc in cursor:
-                document.append(doc)
-        else:
-            document = self._db[collection].find_one(filter=query, **kwargs)
+        with MONGO_QUERY_DURATION.time(operation="find" if many else "find_one", collection=collection):
+            if many:
+                document = []
+                cursor = self._db[collection].find(filter=query, **kwargs)
+                for doc in cursor:
+                    document.append(doc)
+            else:
+                document = self._db[collection].find_one(filter=query, **kwargs)
         return document
 
-    def update_one(self, collection, query, data):
-        document = self._db[collection].update_one(filter=query, update=data)
+    def update_one(self, collection, query, data, upsert=False):
+        with MONGO_QUERY_DURATION.time(operation="update_one", collection=collection):
+            document = self._db[collection].update_one(filter=query, update=data, upsert=upsert)
+        return document
+
+    def find_one_and_update(self, collection, query, data):
+        with MONGO_QUERY_DURATION.time(operation="find_one_and_update", collection=collection):
+            document = self._db[collection].find_one_and_update(
+                filter=query, update=data, return_document=ReturnDocument.AFTER
+            )
         return document
 
     def delete_one(self, collection, query):
-        document = self._db[collection].delete_one(filter=query)
+        with MONGO_QUERY_DURATION.time(operation="delete_one", collection=collection):
+            document = self._db[collection].delete_one(filter=query)
         return document
 
     def drop(self, collection):
         self._db[collection].drop()
 
+    def create_index(self, collection, key, unique=False):
+        self._db[collection].create_index(key, unique=unique)
+
 
 class ReceiptsDBConnector(MongoBase):
     RECEIPTS = "receipts_collection"
+    CHATS = "chats_collection"
+    LEDGER = "ledger_collection"
+    BALANCES = "balances_collection"
+    DEBUG_SAMPLE_RATE = 0.1
 
-    def __init__(self):
-        behavior_log("Init {connector}".format(connector=type(self).__name__))
-        super().__init__()
+    def __init__(self, client=None):
+        behavior_log("Init {connector}", connector=type(self).__name__)
+        super().__init__(client)
+
+    def prepare(self):
         self.drop(self.RECEIPTS)
+        self.drop(self.CHATS)
+        self.create_index(self.RECEIPTS, RECEIPT_ID, unique=True)
+        self.create_index(self.CHATS, CHAT_ID, unique=True)
+        self.create_index(self.LEDGER, RECEIPT_ID, unique=True)
+        self.create_index(self.LEDGER, CHAT_ID)
+        self.create_index(self.LEDGER, IS_APPLIED)
+        self.create_index(self.BALANCES, CHAT_ID, unique=True)
+        self.apply_pending_settlements()
 
     @property
     def receipt_document(self):
@@ -65,8 +96,17 @@ class ReceiptsDBConnector(MongoBase):
             ACCESS_TIMESTAMP: time.time(),
             IS_RECEIPT_CLOSED: False,
             VOTERS_COUNT: 0,
+            CLOSED_USERS: [],
             TOTAL_VOTERS_COUNT: 0,
-            RECEIPT_MARKUP: None,
+            CLAIMS: {},
+            CLAIMED_UNITS: {},
+            USER_TOTALS: {},
+            VALUE_SCALE: 1,
+            TOTAL_VALUE: 0,
+            CLAIMED_VALUE: 0,
+            PHOTO_SIZES: [],
+            PAYER_ID: "",
+            PAYER_NAME: "",
             USERS: {}
         }
 
@@ -74,42 +114,67 @@ class ReceiptsDBConnector(MongoBase):
     def user(self):
         return {
             USER_ID: "",
+            USER_NAME: "",
             DEBT_SUM: 0,
-            OPTIONS_MARKUP: []
+            POLL_PAGE: 0,
+            EXPANDED_ITEM: None,
+            CUSTOM_STEP_ITEMS: []
         }
 
     def set_receipt(self, document):
-        behavior_log("Insert in {coll} document: {doc}".format(coll=self.RECEIPTS, doc=document))
+        behavior_log(
+            "Insert in {coll} document: {doc}", level="DEBUG",
+            coll=self.RECEIPTS, doc=document, receipt_id=document[RECEIPT_ID], chat_id=document[CHAT_ID]
+        )
         self.insert_one(collection=self.RECEIPTS, data=document)
-        behavior_log("Document was successfully inserted")
+        self.set_active_receipt(chat_id=document[CHAT_ID], receipt_id=document[RECEIPT_ID])
+        behavior_log("Document was successfully inserted", level="DEBUG")
+
+    def set_active_receipt(self, chat_id, receipt_id):
+        self.update_one(
+            collection=self.CHATS,
+            query={
+                CHAT_ID: chat_id
+            },
+            data={"$set": {ACTIVE_RECEIPT_ID: receipt_id}},
+            upsert=True
+        )
+
+    def get_active_receipt_id(self, chat_id):
+        chat = self.find(
+            collection=self.CHATS,
+            query={
+                CHAT_ID: chat_id
+            }
+        )
+        return chat[ACTIVE_RECEIPT_ID] if chat else None
 
     def get_dialog_state(self, chat_id):
         current_receipt = self.find(
             collection=self.RECEIPTS,
             query={
-                CHAT_ID: chat_id
+                RECEIPT_ID: self.get_active_receipt_id(chat_id)
             },
-            sort=[(ACCESS_TIMESTAMP, -1)]
+            projection={DIALOG_STATE_ID: True}
         )
         return current_receipt[DIALOG_STATE_ID] if current_receipt else None
 
     def get_receipt(self, keys, **kwargs):
-        behavior_log("Find document in {coll} by query: {query}".format(coll=self.RECEIPTS, query=keys))
+        behavior_log("Find document in {coll} by query: {query}", level="DEBUG", coll=self.RECEIPTS, query=keys)
         receipt = self.find(
             collection=self.RECEIPTS,
             query=keys,
             **kwargs
         )
-        behavior_log("Document was successfully found: {doc}".format(doc=receipt))
+        behavior_log("Document was successfully found: {doc}", level="DEBUG", sample_rate=self.DEBUG_SAMPLE_RATE, doc=receipt)
         return receipt if receipt else {}
 
     def get_receipt_by_state(self, chat_id, state_id):
         return self.get_receipt(
             keys={
-                CHAT_ID: chat_id,
+                RECEIPT_ID: self.get_active_receipt_id(chat_id),
                 DIALOG_STATE_ID: state_id
-            },
-            sort=[(ACCESS_TIMESTAMP, -1)]
+            }
         )
 
     def update_receipt_by_id(self, receipt_id, update):
@@ -120,7 +185,7 @@ class ReceiptsDBConnector(MongoBase):
             value = value if self.pickle_check(value) else pickle.dumps(value)
             mongo_update[set_key][key] = value
 
-        behavior_log("Update document in {coll} by id: {id}".format(coll=self.RECEIPTS, id=receipt_id))
+        behavior_log("Update document in {coll} by id: {receipt_id}", level="DEBUG", coll=self.RECEIPTS, receipt_id=receipt_id)
         self.update_one(
             collection=self.RECEIPTS,
             query={
@@ -128,7 +193,128 @@ class ReceiptsDBConnector(MongoBase):
             },
             data=mongo_update
         )
-        behavior_log("Document was successfully updated. Update data: {data}".format(data=update))
+        behavior_log(
+            "Document was successfully updated. Update data: {data}", level="DEBUG",
+            sample_rate=self.DEBUG_SAMPLE_RATE, data=update, receipt_id=receipt_id
+        )
+
+    def update_user_claim(self, receipt_id, user, change):
+        user_id = user[USER_ID]
+        claim_key = "{}.{}.{}".format(CLAIMS, change.item_id, user_id)
+        units_key = "{}.{}".format(CLAIMED_UNITS, change.item_id)
+        previous_units = change.previous_units
+        data = {
+            "$set": {"{}.{}".format(USERS, user_id): user, ACCESS_TIMESTAMP: time.time()},
+            "$inc": {
+                units_key: change.units - previous_units,
+                "{}.{}".format(USER_TOTALS, user_id): change.user_value,
+                CLAIMED_VALUE: change.claimed_value
+            }
+        }
+        if change.units:
+            data["$set"][claim_key] = change.units
+        else:
+            data["$unset"] = {claim_key: ""}
+
+        # the claim and the item total are compared with the ones the change was computed from,
+        # so concurrent taps never overwrite each other or miscount an overclaimed item
+        return self.find_one_and_update(
+            collection=self.RECEIPTS,
+            query={
+                RECEIPT_ID: receipt_id,
+                IS_RECEIPT_CLOSED: False,
+                CLOSED_USERS: {"$ne": user_id},
+                claim_key: previous_units if previous_units else {"$exists": False},
+                units_key: change.item_units if change.item_units else {"$in": [0, None]}
+            },
+            data=data
+        )
+
+    def close_user_vote(self, receipt_id, user_id):
+        receipt = self.find_one_and_update(
+            collection=self.RECEIPTS,
+            query={
+                RECEIPT_ID: receipt_id,
+                CLOSED_USERS: {"$ne": user_id}
+            },
+            data={
+                "$addToSet": {CLOSED_USERS: user_id},
+                "$inc": {VOTERS_COUNT: 1},
+                "$set": {ACCESS_TIMESTAMP: time.time()}
+            }
+        )
+        return receipt[VOTERS_COUNT] if receipt else None
+
+    def mark_receipt_closed(self, receipt_id, state_id):
+        receipt = self.find_one_and_update(
+            collection=self.RECEIPTS,
+            query={
+                RECEIPT_ID: receipt_id,
+                IS_RECEIPT_CLOSED: False
+            },
+            data={"$set": {IS_RECEIPT_CLOSED: True, DIALOG_STATE_ID: state_id, ACCESS_TIMESTAMP: time.time()}}
+        )
+        return receipt is not None
+
+    def record_settlement(self, entry, changes, names):
+        entry = dict(entry, **{BALANCE_CHANGES: changes, USER_NAME: names, IS_APPLIED: False})
+        try:
+            self.insert_one(collection=self.LEDGER, data=entry)
+        except DuplicateKeyError:
+            behavior_log("Receipt {receipt_id} is already in the ledger", level="WARNING", receipt_id=entry[RECEIPT_ID])
+            return False
+        self.apply_settlement(entry)
+        return True
+
+    def apply_settlement(self, entry):
+        # the pending marker makes a retried $inc a no-op until the entry is marked as applied
+        pending_key = "{}.{}".format(PENDING_RECEIPTS, entry[RECEIPT_ID])
+        update = {"$set": {"{}.{}".format(USER_NAME, user_id): name for user_id, name in entry[USER_NAME].items()}}
+        update["$set"][pending_key] = True
+        if entry[BALANCE_CHANGES]:
+            update["$inc"] = {
+                "{}.{}".format(BALANCES, user_id): change for user_id, change in entry[BALANCE_CHANGES].items()
+            }
+        query = {
+            CHAT_ID: entry[CHAT_ID],
+            pending_key: {"$exists": False}
+        }
+        try:
+            self.update_one(collection=self.BALANCES, query=query, data=update, upsert=True)
+        except DuplicateKeyError:
+            # either the marker is set or another process has just created the chat's balances, retry to tell them apart
+            if not self.update_one(collection=self.BALANCES, query=query, data=update).matched_count:
+                behavior_log("Receipt {receipt_id} is already applied to balances", level="WARNING",
+                             receipt_id=entry[RECEIPT_ID])
+
+        self.update_one(
+            collection=self.LEDGER,
+            query={
+                RECEIPT_ID: entry[RECEIPT_ID]
+            },
+            data={"$set": {IS_APPLIED: True}}
+        )
+        self.update_one(
+            collection=self.BALANCES,
+            query={
+                CHAT_ID: entry[CHAT_ID]
+            },
+            data={"$unset": {pending_key: ""}}
+        )
+
+    def apply_pending_settlements(self):
+        for entry in self.find(collection=self.LEDGER, query={IS_APPLIED: False}, many=True):
+            behavior_log("Apply pending ledger entry of receipt {receipt_id}", receipt_id=entry[RECEIPT_ID])
+            self.apply_settlement(entry)
+
+    def get_balances(self, chat_id):
+        balances = self.find(
+            collection=self.BALANCES,
+            query={
+                CHAT_ID: chat_id
+            }
+        )
+        return balances if balances else {}
 
     @property
     def all_documents(self):
@@ -136,13 +322,50 @@ class ReceiptsDBConnector(MongoBase):
 
 
 class RedisConnector:
+    SOCKET_TIMEOUT = 0.5
+    RETRY_SECONDS = 30
+
     def __init__(self):
-        self._db = Redis()
-        self.flush()
+        self._db = Redis(socket_connect_timeout=self.SOCKET_TIMEOUT, socket_timeout=self.SOCKET_TIMEOUT)
+        self._fallback = InMemoryConnector()
+        self._retry_at = 0
+
+    def is_available(self):
+        try:
+            return bool(self._db.ping())
+        except RedisError:
+            self.mark_unreachable()
+            return False
+
+    def is_reachable(self):
+        return time.monotonic() >= self._retry_at
+
+    def mark_unreachable(self):
+        behavior_log(
+            "Redis is unreachable, using in-memory fallback for {seconds} s", level="WARNING", exc_info=True,
+            seconds=self.RETRY_SECONDS
+        )
+        self._retry_at = time.monotonic() + self.RETRY_SECONDS
 
     def set(self, key, value):
         self._db.set(key, value)
 
+    def set_if_absent(self, key, value, ttl):
+        if self.is_reachable():
+            try:
+                return bool(self._db.set(key, value, nx=True, ex=ttl))
+            except RedisError:
+                self.mark_unreachable()
+        return self._fallback.set_if_absent(key, value, ttl)
+
+    def delete(self, key):
+        self._fallback.delete(key)
+        if self.is_reachable():
+            try:
+                self._db.delete(key)
+            except RedisError:
+                self.mark_unreachable()
+
     def get(self, key):
         value = self._db.get(key)
         if isinstance(value, bytes):
@@ -156,3 +379,46 @@ class RedisConnector:
     def flush(self):
         for key in self.all_keys:
             self._db.delete(key)
+
+
+class InMemoryConnector:
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        self._values = OrderedDict()
+
+    def expire(self):
+        now = time.monotonic()
+        while self._values:
+            key, (_, expires_at) = next(iter(self._values.items()))
+            if expires_at > now and len(self._values) <= self.MAX_KEYS:
+                break
+            del self._values[key]
+
+    def is_available(self):
+        return True
+
+    def set(self, key, value, ttl=float("inf")):
+        self._values.pop(key, None)
+        self._values[key] = (value, time.monotonic() + ttl)
+        self.expire()
+
+    def set_if_absent(self, key, value, ttl):
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, ttl)
+        return True
+
+    def get(self, key):
+        value, expires_at = self._values.get(key, (None, 0))
+        return value if expires_at > time.monotonic() else None
+
+    def delete(self, key):
+        self._values.pop(key, None)
+
+    @property
+    def all_keys(self):
+        return [key for key in self._values if self.get(key) is not None]
+
+    def flush(self):
+        self._values.clear()
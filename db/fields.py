@@ -3,14 +3,36 @@ DEBT_SUM = "debt_sum"
 RAW_ITEMS = "raw_items"
 CLEAN_ITEMS = "clean_items"
 VOTERS_COUNT = "voters_count"
-OPTIONS_MARKUP = "options_markup"
-RECEIPT_MARKUP = "receipt_markup"
+CLOSED_USERS = "closed_users"
+POLL_PAGE = "poll_page"
+EXPANDED_ITEM = "expanded_item"
+CUSTOM_STEP_ITEMS = "custom_step_items"
+CLAIMS = "claims"
+USER_TOTALS = "user_totals"
+CLAIMED_UNITS = "claimed_units"
+VALUE_SCALE = "value_scale"
+TOTAL_VALUE = "total_value"
+CLAIMED_VALUE = "claimed_value"
+PHOTO_SIZES = "photo_sizes"
+WIDTH = "width"
+HEIGHT = "height"
+FILE_SIZE = "file_size"
+USER_NAME = "user_name"
+DEBTS = "debts"
+BALANCES = "balances"
+BALANCE_CHANGES = "balance_changes"
+PENDING_RECEIPTS = "pending_receipts"
 
 CHAT_ID = "chat_id"
 USER_ID = "user_id"
+PAYER_ID = "payer_id"
+PAYER_NAME = "payer_name"
 RECEIPT_ID = "receipt_id"
+ACTIVE_RECEIPT_ID = "active_receipt_id"
 DIALOG_STATE_ID = "dialog_state_id"
 
 TOTAL_VOTERS_COUNT = "total_voters_count"
 ACCESS_TIMESTAMP = "access_timestamp"
+CLOSE_TIMESTAMP = "close_timestamp"
 IS_RECEIPT_CLOSED = "is_receipt_closed"
+IS_APPLIED = "is_applied"
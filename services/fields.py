@@ -3,3 +3,7 @@ NAME = "name"
 PRICE = "price"
 QUANTITY = "quantity"
 ITEMS = "items"
+TOP = "top"
+BOTTOM = "bottom"
+CONFIDENCE = "confidence"
+SOURCE = "source"
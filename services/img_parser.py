@@ -3,165 +3,176 @@ import io
 import re
 import asyncio
 import fnmatch
+import importlib
 from copy import copy
 from functools import partial
+from types import SimpleNamespace
+from collections import namedtuple
 from concurrent.futures import ProcessPoolExecutor
-from wand.image import Image as WandImage
-
-import cv2
-import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-from pytesseract import pytesseract
-from imutils.perspective import four_point_transform
-from receipt_parser_core.enhancer import enhance_image, sharpen_image
-from receipt_parser_core.config import read_config
-
-from bot_config import PARSER_CONFIG_PATH, INPUT_FOLDER, TMP_FOLDER
-from utils.logger import behavior_log
-from services.fields import NAME, QUANTITY, PRICE
-
-
-class ImageParser:
-    def __init__(self):
-        self._config = read_config(PARSER_CONFIG_PATH)
-        behavior_log("Init {parser}".format(parser=type(self).__name__))
-
-    @property
-    def item(self):
-        return {
-            NAME: "",
-            QUANTITY: 0,
-            PRICE: 0
-        }
 
-    @staticmethod
-    def plot_rgb(image):
-        plt.figure(figsize=(16, 10))
-        return plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+from bot_config import get_config, PARSER_CONFIG_PATH
+from utils.logger import behavior_log
+from utils.metrics import stage_timer, STAGE_DURATION, OCR_POOL_WORKERS, OCR_POOL_BUSY, OCR_POOL_QUEUE_DEPTH, \
+    PHOTO_LONG_SIDE, OCR_IMAGE_SCALE
+from services.fields import NAME, QUANTITY, PRICE, TOP, BOTTOM, CONFIDENCE
+from services.scratch_storage import ScratchStorage
 
-    @staticmethod
-    def plot_gray(image):
-        plt.figure(figsize=(16, 10))
-        return plt.imshow(image, cmap='Greys_r')
+OCR_WORKER_MODULE = "services.ocr_worker"
 
-    @staticmethod
-    def opencv_resize(image, ratio):
-        width = int(image.shape[1] * ratio)
-        height = int(image.shape[0] * ratio)
-        dim = (width, height)
-        return cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
 
-    @staticmethod
-    def approximate_contour(contour):
-        peri = cv2.arcLength(contour, True)
-        return cv2.approxPolyDP(contour, 0.032 * peri, True)
+def run_worker_task(task, *args):
+    return getattr(importlib.import_module(OCR_WORKER_MODULE), task)(*args)
 
-    def get_receipt_contour(self, contours):
-        for c in contours:
-            approx = self.approximate_contour(c)
-            if len(approx) == 4:
-                return approx
 
-    @staticmethod
-    def contour_to_rectangle(contour, resize_ratio):
-        pts = contour.reshape(4, 2)
-        rect = np.zeros((4, 2), dtype="float32")
-
-        s = pts.sum(axis=1)
-        rect[0] = pts[np.argmin(s)]
-        rect[2] = pts[np.argmax(s)]
-
-        diff = np.diff(pts, axis=1)
-        rect[1] = pts[np.argmin(diff)]
-        rect[3] = pts[np.argmax(diff)]
-        return rect / resize_ratio
-
-    def _resize_and_blur(self, image, resize_ratio):
-        image = self.opencv_resize(image, resize_ratio)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
-        return cv2.dilate(blurred, rect_kernel)
+OcrLine = namedtuple("OcrLine", ["text", "confidence", "top", "bottom"])
 
-    @staticmethod
-    def _find_receipt_contours(dilated_image):
-        edged = cv2.Canny(dilated_image, 50, 200, apertureSize=3)
-        contours, hierarchy = cv2.findContours(edged, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        largest_contours = sorted(contours, key=cv2.contourArea, reverse=True)[:10]
-        return largest_contours
-
-    def find_receipt_on_image_and_crop_it(self, filename):
-        img = Image.open(filename)
-        img.thumbnail((800, 800), Image.ANTIALIAS)
-        image = cv2.imread(filename)
-        original = image.copy()
-
-        resize_ratio = 500 / image.shape[0]
-        dilated = self._resize_and_blur(image, resize_ratio)
-        largest_contours = self._find_receipt_contours(dilated)
-        receipt_contour = self.get_receipt_contour(largest_contours)
-
-        if receipt_contour is not None and len(receipt_contour) > 0:
-            scanned = four_point_transform(original.copy(), self.contour_to_rectangle(receipt_contour, resize_ratio))
-            cv2.imwrite(filename, scanned)
-
-    def sharpen_image_and_run_ocr(self, tmp_path):
-        sharpen_image(tmp_path, tmp_path, rotate=False)
-        with io.BytesIO() as transfer:
-            with WandImage(filename=tmp_path) as img:
-                img.save(transfer)
-
-            with Image.open(transfer) as img:
-                image_data = pytesseract.image_to_string(
-                    img, lang=self._config.language, timeout=5, config="--psm 6"
-                )
-        return image_data
 
-    @staticmethod
-    def _enhance_image(filename, blur=False):
-        input_path = INPUT_FOLDER + "/" + filename
-        img = enhance_image(cv2.imread(input_path), gaussian_blur=blur)
+class ImageParser:
+    TSV_COLUMNS = 12
+    WORD_LEVEL = "5"
+    LINE_OVERLAP_RATIO = 0.5
+    OCR_WORKERS = os.cpu_count() or 2
+    # preprocessing upscales by 1.2 afterwards, so Tesseract gets lines of ~30px
+    TARGET_TEXT_HEIGHT = 26
+    EXPECTED_TEXT_LINES = 48
+    MIN_SCALE, MAX_SCALE = 0.33, 3.0
+    OCR_VARIANTS = ("sharpen_binarized", "sharpen_plain")
 
-        prefix = "1" if blur else "2"
-        tmp_path = os.path.join(TMP_FOLDER, prefix + filename)
+    def __init__(self):
+        self._config = SimpleNamespace(**get_config(PARSER_CONFIG_PATH))
+        self.storage = ScratchStorage()
+        self._pool = None
+        self._busy_jobs = 0
+        OCR_POOL_WORKERS.set(self.OCR_WORKERS)
+        OCR_POOL_BUSY.set_function(lambda: self._busy_jobs)
+        OCR_POOL_QUEUE_DEPTH.set_function(lambda: max(self._busy_jobs - self.OCR_WORKERS, 0))
+        behavior_log("Init {parser}", parser=type(self).__name__)
 
-        cv2.imwrite(tmp_path, img)
-        return tmp_path
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.OCR_WORKERS)
+        return self._pool
 
-    async def parse(self, filename):
-        behavior_log("Start processing image {name}".format(name=filename))
+    def close(self, wait=False):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
 
-        blurred_img = self._enhance_image(filename, blur=True)
-        non_blurred_img = self._enhance_image(filename, blur=False)
-        blur_index, non_blur_index = 0, 1
+    @property
+    def item(self):
+        return {
+            NAME: "",
+            QUANTITY: 0,
+            PRICE: 0,
+            CONFIDENCE: 0,
+            TOP: 0,
+            BOTTOM: 0
+        }
 
+    async def run_in_pool(self, task, *args):
         loop = asyncio.get_running_loop()
-        with ProcessPoolExecutor(max_workers=2) as pool:
-            futures = [
-                loop.run_in_executor(pool, partial(self.sharpen_image_and_run_ocr, blurred_img)),
-                loop.run_in_executor(pool, partial(self.sharpen_image_and_run_ocr, non_blurred_img))
-            ]
-            result = await asyncio.gather(*futures)
-
-        items = [self.extract_items(result[i].splitlines(True)) for i in range(len(result))]
-        if len(items[blur_index]) >= len(items[non_blur_index]):
-            return items[blur_index]
-        else:
-            return items[non_blur_index]
-
-    def extract_items(self, receipt_lines):
+        self._busy_jobs += 1
+        try:
+            return await loop.run_in_executor(self.pool, partial(run_worker_task, task, *args))
+        finally:
+            self._busy_jobs -= 1
+
+    async def warm_up(self):
+        return await asyncio.gather(*[self.run_in_pool("warm_up") for _ in range(self.OCR_WORKERS)])
+
+    async def find_receipt_on_image_and_crop_it(self, image_path):
+        await self.run_in_pool("find_receipt_on_image_and_crop_it", image_path)
+
+    def choose_photo_size(self, photo_sizes):
+        min_long_side = self.TARGET_TEXT_HEIGHT * self.EXPECTED_TEXT_LINES
+        photo_sizes = sorted(photo_sizes, key=lambda size: max(size.width, size.height))
+        photo_size = next(
+            (size for size in photo_sizes if max(size.width, size.height) >= min_long_side), photo_sizes[-1]
+        )
+        PHOTO_LONG_SIDE.observe(max(photo_size.width, photo_size.height))
+        return photo_size
+
+    async def preprocess(self, image_path):
+        images, timings, scale, text_height = await self.run_in_pool(
+            "preprocess_image", image_path, self.OCR_VARIANTS, self.TARGET_TEXT_HEIGHT, self.MIN_SCALE, self.MAX_SCALE
+        )
+        for stage, duration in timings.items():
+            STAGE_DURATION.observe(duration, stage="preprocess_" + stage)
+        OCR_IMAGE_SCALE.observe(scale)
+        behavior_log(
+            "Image {name} rescaled by {scale:.2f}, estimated text height {text_height}",
+            name=os.path.basename(image_path), scale=scale, text_height=text_height
+        )
+        return images
+
+    async def run_ocr(self, image):
+        ocr_data, duration = await self.run_in_pool("run_ocr", image, self._config.language)
+        STAGE_DURATION.observe(duration, stage="ocr_pass")
+        return ocr_data
+
+    async def parse_progressively(self, image_path):
+        behavior_log("Start processing image {name}", name=os.path.basename(image_path))
+        with stage_timer("image_preprocessing", name=os.path.basename(image_path)):
+            images = await self.preprocess(image_path)
+        variants, best_items, error = [], [], None
+
+        for future in asyncio.as_completed([self.run_ocr(image) for image in images]):
+            try:
+                ocr_data = await future
+            except Exception as e:
+                error = e
+                behavior_log("OCR variant failed for {name}", level="ERROR", exc_info=True,
+                             name=os.path.basename(image_path))
+                continue
+            variants.append(self.extract_items(self.iter_ocr_lines(ocr_data)))
+            items = self.merge_items(*variants)
+            if self.items_score(items) > self.items_score(best_items):
+                is_changed = self.items_view(items) != self.items_view(best_items)
+                best_items = items
+                if is_changed:
+                    yield best_items
+        if error is not None and not best_items:
+            raise error
+
+    async def parse(self, image_path):
         items = []
-        for line in receipt_lines:
+        async for items in self.parse_progressively(image_path):
+            pass
+        return items
+
+    def iter_ocr_lines(self, ocr_data):
+        line_key, words, confidences, top, bottom = None, [], [], 0, 0
+        rows = io.StringIO(ocr_data)
+        next(rows, None)
+        for row in rows:
+            columns = row.rstrip("\n").split("\t")
+            if len(columns) < self.TSV_COLUMNS or columns[0] != self.WORD_LEVEL or not columns[11].strip():
+                continue
+
+            key = tuple(columns[1:5])
+            word_top, word_height = int(columns[7]), int(columns[9])
+            if key != line_key:
+                if words:
+                    yield OcrLine(" ".join(words), sum(confidences) / len(confidences), top, bottom)
+                line_key, words, confidences = key, [], []
+                top, bottom = word_top, word_top + word_height
+
+            words.append(columns[11])
+            confidences.append(max(float(columns[10]), 0))
+            top, bottom = min(top, word_top), max(bottom, word_top + word_height)
+
+        if words:
+            yield OcrLine(" ".join(words), sum(confidences) / len(confidences), top, bottom)
+
+    def iter_items(self, ocr_lines):
+        for line in ocr_lines:
             for stop_word in self._config.sum_keys:
-                if fnmatch.fnmatch(line, f"*{stop_word}*"):
-                    return items
+                if fnmatch.fnmatch(line.text, f"*{stop_word}*"):
+                    return
 
-            match = re.search(self._config.item_format, line)
+            match = re.search(self._config.item_format, line.text)
             if hasattr(match, "group") and len(match.groups()) >= 3:
-                line = line.lower().replace("\n", "")
-                behavior_log("Matched line with receipt option regexp: {line}".format(line=line))
-
                 name, quantity, price = self.get_item_attrs(regexp_match=match)
 
                 if len(name) > 3:
@@ -171,13 +182,55 @@ class ImageParser:
                         if parse_stop:
                             break
                     if not parse_stop:
-                        item = self.set_item_attrs(name, quantity, price)
+                        item = self.set_item_attrs(name, quantity, price, line=line)
                         if item:
-                            items.append(item)
+                            yield item
 
-        behavior_log("Finish image processing and sending items to bot")
+    def extract_items(self, ocr_lines):
+        with stage_timer("extract_items"):
+            items = list(self.iter_items(ocr_lines))
+        behavior_log("Extracted {count} items from image", count=len(items))
         return items
 
+    def merge_items(self, *variants):
+        def _overlap(item, other):
+            return min(item[BOTTOM], other[BOTTOM]) - max(item[TOP], other[TOP])
+
+        def _same_line(item, other):
+            height = min(item[BOTTOM] - item[TOP], other[BOTTOM] - other[TOP])
+            return _overlap(item, other) > height * self.LINE_OVERLAP_RATIO
+
+        tagged_items = sorted(
+            ((variant_id, item) for variant_id, items in enumerate(variants) for item in items),
+            key=lambda tagged_item: tagged_item[1][TOP]
+        )
+        # only items read by different variants are paired, lines of one variant never replace each other
+        lines = []
+        for variant_id, item in tagged_items:
+            best_line = None
+            for line in reversed(lines):
+                if _overlap(item, line[1]) <= 0:
+                    break
+                if variant_id not in line[0] and _same_line(item, line[1]):
+                    if best_line is None or _overlap(item, line[1]) > _overlap(item, best_line[1]):
+                        best_line = line
+
+            if best_line is None:
+                lines.append([{variant_id}, item])
+                continue
+            best_line[0].add(variant_id)
+            if item[CONFIDENCE] > best_line[1][CONFIDENCE]:
+                best_line[1] = item
+        return [line[1] for line in lines]
+
+    @staticmethod
+    def items_view(items):
+        return [(item[NAME], item[QUANTITY], item[PRICE]) for item in items]
+
+    @staticmethod
+    def items_score(items):
+        return len(items), sum(item[CONFIDENCE] for item in items)
+
     @staticmethod
     def get_item_attrs(regexp_match):
         name = regexp_match.group(1)
@@ -185,7 +238,7 @@ class ImageParser:
         price = regexp_match.group(3).replace(",", ".")
         return name, quantity, price
 
-    def set_item_attrs(self, name, quantity, price):
+    def set_item_attrs(self, name, quantity, price, line=None):
         item = copy(self.item)
         try:
             quantity = float(quantity)
@@ -196,4 +249,7 @@ class ImageParser:
             item[NAME] = name.lower()
             item[QUANTITY] = int(quantity / 100) if quantity >= 100 else int(quantity)
             item[PRICE] = price
+            if line:
+                item[CONFIDENCE] = line.confidence
+                item[TOP], item[BOTTOM] = line.top, line.bottom
         return item
@@ -0,0 +1,61 @@
+import re
+from copy import copy
+from collections import Counter, defaultdict
+
+from services.fields import NAME, PRICE, QUANTITY, SOURCE
+
+
+class ItemsCombiner:
+    TOKEN_REGEXP = re.compile(r"\w+")
+    MIN_TOKEN_LEN = 2
+    SIMILARITY_THRESHOLD = 0.5
+    PRICE_PRECISION = 2
+
+    def tokenize(self, name):
+        return frozenset(
+            token for token in self.TOKEN_REGEXP.findall(name.lower()) if len(token) >= self.MIN_TOKEN_LEN
+        )
+
+    def unit_price(self, item):
+        quantity = item.get(QUANTITY) or 1
+        return round(float(item.get(PRICE)) / quantity, self.PRICE_PRECISION)
+
+    @staticmethod
+    def similarity(shared_count, tokens, other_tokens):
+        return shared_count / (len(tokens) + len(other_tokens) - shared_count)
+
+    def group_key(self, item):
+        return self.unit_price(item), item.get(SOURCE)
+
+    def find_group(self, tokens, group_key, words_index, groups_tokens, groups_keys):
+        shared_counts = Counter()
+        for token in tokens:
+            shared_counts.update(words_index.get(token, ()))
+
+        best_group, best_similarity = None, self.SIMILARITY_THRESHOLD
+        for group_id, shared_count in shared_counts.items():
+            if groups_keys[group_id] != group_key:
+                continue
+            similarity = self.similarity(shared_count, tokens, groups_tokens[group_id])
+            if similarity >= best_similarity:
+                best_group, best_similarity = group_id, similarity
+        return best_group
+
+    def combine(self, items):
+        words_index = defaultdict(set)
+        groups, groups_tokens, groups_keys = [], [], []
+        for item in items:
+            tokens, group_key = self.tokenize(item.get(NAME)), self.group_key(item)
+            group_id = self.find_group(tokens, group_key, words_index, groups_tokens, groups_keys)
+            if group_id is None:
+                group_id = len(groups)
+                groups.append(copy(item))
+                groups_tokens.append(tokens)
+                groups_keys.append(group_key)
+                for token in tokens:
+                    words_index[token].add(group_id)
+            else:
+                group = groups[group_id]
+                group[QUANTITY] += item.get(QUANTITY) or 1
+                group[PRICE] += item.get(PRICE)
+        return groups
@@ -0,0 +1,69 @@
+import heapq
+
+
+class Ledger:
+    EXACT_SEARCH_LIMIT = 12
+
+    def __init__(self, balances):
+        self.balances = {user_id: amount for user_id, amount in balances.items() if amount}
+
+    @staticmethod
+    def receipt_changes(payer_id, debts):
+        changes = {payer_id: 0}
+        for user_id, debt in debts.items():
+            if user_id == payer_id or not debt:
+                continue
+            changes[user_id] = changes.get(user_id, 0) - debt
+            changes[payer_id] += debt
+        return {user_id: change for user_id, change in changes.items() if change}
+
+    def transfers(self):
+        users = sorted(self.balances)
+        if len(users) <= self.EXACT_SEARCH_LIMIT:
+            groups = self.zero_sum_groups(users)
+        else:
+            groups = [users]
+        return [transfer for group in groups for transfer in self.settle_group(group)]
+
+    def zero_sum_groups(self, users):
+        # the fewest transfers is len(users) minus the largest number of disjoint zero-sum groups
+        masks_count = 1 << len(users)
+        sums, groups_count = [0] * masks_count, [0] * masks_count
+        for mask in range(1, masks_count):
+            lowest_bit = mask & -mask
+            sums[mask] = sums[mask ^ lowest_bit] + self.balances[users[lowest_bit.bit_length() - 1]]
+            groups_count[mask] = max(groups_count[mask ^ (1 << i)] for i in range(len(users)) if mask >> i & 1)
+            groups_count[mask] += sums[mask] == 0
+
+        mask, group, groups = masks_count - 1, [], []
+        while mask:
+            for i in range(len(users)):
+                previous_mask = mask ^ (1 << i)
+                if mask >> i & 1 and groups_count[previous_mask] + (sums[mask] == 0) == groups_count[mask]:
+                    break
+            group.append(users[i])
+            mask = previous_mask
+            if sums[mask] == 0:
+                groups.append(group)
+                group = []
+        if group:
+            groups.append(group)
+        return groups
+
+    def settle_group(self, users):
+        debtors = [(self.balances[user_id], user_id) for user_id in users if self.balances[user_id] < 0]
+        creditors = [(-self.balances[user_id], user_id) for user_id in users if self.balances[user_id] > 0]
+        heapq.heapify(debtors)
+        heapq.heapify(creditors)
+
+        transfers = []
+        while debtors and creditors:
+            debt, debtor = heapq.heappop(debtors)
+            credit, creditor = heapq.heappop(creditors)
+            amount = min(-debt, -credit)
+            transfers.append((debtor, creditor, amount))
+            if debt + amount:
+                heapq.heappush(debtors, (debt + amount, debtor))
+            if credit + amount:
+                heapq.heappush(creditors, (credit + amount, creditor))
+        return transfers
@@ -0,0 +1,92 @@
+import os
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+from pytesseract import pytesseract
+from imutils.perspective import four_point_transform
+
+from services.preprocessing import RECEIPT_GRAPH
+
+
+def warm_up():
+    return os.getpid()
+
+
+def preprocess_image(image_path, outputs, target_text_height, min_scale, max_scale):
+    context = dict(target_text_height=target_text_height, min_scale=min_scale, max_scale=max_scale)
+    images, timings = RECEIPT_GRAPH.run(image_path, outputs, context)
+    return [images[output] for output in outputs], timings, context["scale"], context["text_height"]
+
+
+def run_ocr(image, language):
+    start_time = time.perf_counter()
+    image_data = pytesseract.image_to_data(
+        Image.fromarray(image), lang=language, timeout=5, config="--psm 6"
+    )
+    return image_data, time.perf_counter() - start_time
+
+
+def opencv_resize(image, ratio):
+    width = int(image.shape[1] * ratio)
+    height = int(image.shape[0] * ratio)
+    dim = (width, height)
+    return cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
+
+
+def approximate_contour(contour):
+    peri = cv2.arcLength(contour, True)
+    return cv2.approxPolyDP(contour, 0.032 * peri, True)
+
+
+def get_receipt_contour(contours):
+    for c in contours:
+        approx = approximate_contour(c)
+        if len(approx) == 4:
+            return approx
+
+
+def contour_to_rectangle(contour, resize_ratio):
+    pts = contour.reshape(4, 2)
+    rect = np.zeros((4, 2), dtype="float32")
+
+    s = pts.sum(axis=1)
+    rect[0] = pts[np.argmin(s)]
+    rect[2] = pts[np.argmax(s)]
+
+    diff = np.diff(pts, axis=1)
+    rect[1] = pts[np.argmin(diff)]
+    rect[3] = pts[np.argmax(diff)]
+    return rect / resize_ratio
+
+
+def _resize_and_blur(image, resize_ratio):
+    image = opencv_resize(image, resize_ratio)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
+    return cv2.dilate(blurred, rect_kernel)
+
+
+def _find_receipt_contours(dilated_image):
+    edged = cv2.Canny(dilated_image, 50, 200, apertureSize=3)
+    contours, hierarchy = cv2.findContours(edged, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    largest_contours = sorted(contours, key=cv2.contourArea, reverse=True)[:10]
+    return largest_contours
+
+
+def find_receipt_on_image_and_crop_it(filename):
+    img = Image.open(filename)
+    img.thumbnail((800, 800), Image.ANTIALIAS)
+    image = cv2.imread(filename)
+    original = image.copy()
+
+    resize_ratio = 500 / image.shape[0]
+    dilated = _resize_and_blur(image, resize_ratio)
+    largest_contours = _find_receipt_contours(dilated)
+    receipt_contour = get_receipt_contour(largest_contours)
+
+    if receipt_contour is not None and len(receipt_contour) > 0:
+        scanned = four_point_transform(original.copy(), contour_to_rectangle(receipt_contour, resize_ratio))
+        cv2.imwrite(filename, scanned)
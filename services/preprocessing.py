@@ -0,0 +1,106 @@
+import time
+from collections import namedtuple, Counter
+
+import cv2
+import numpy as np
+
+Stage = namedtuple("Stage", ["name", "parent", "function", "inplace"])
+
+ENHANCEMENT_SCALE = 1.2
+SHARPEN_SIGMA = 4.0
+MIN_TEXT_HEIGHT = 4
+TEXT_ROW_INK_RATIO = 0.02
+# ImageMagick "contrast": 0.5 * (sin(pi * (v - 0.5)) + 1) on normalized intensity
+CONTRAST_LUT = np.round(
+    255 * 0.5 * (np.sin(np.pi * (np.arange(256) / 255 - 0.5)) + 1)
+).astype(np.uint8)
+
+
+class PreprocessingGraph:
+    def __init__(self, *stages):
+        self.stages = {stage.name: stage for stage in stages}
+
+    def path(self, output):
+        path = []
+        while output is not None:
+            path.append(output)
+            output = self.stages[output].parent
+        return path[::-1]
+
+    def run(self, source, outputs, context):
+        paths = [self.path(output) for output in outputs]
+        order = sorted({name for path in paths for name in path}, key=lambda name: len(self.path(name)))
+
+        consumers = Counter(self.stages[name].parent for name in order)
+        consumers.update(outputs)
+        results, timings = {None: source}, {}
+        for name in order:
+            stage = self.stages[name]
+            image = results[stage.parent]
+            if stage.inplace and consumers[stage.parent] > 1:
+                image = image.copy()
+
+            start_time = time.perf_counter()
+            results[name] = stage.function(image, context)
+            timings[name] = time.perf_counter() - start_time
+
+            consumers[stage.parent] -= 1
+            if not consumers[stage.parent]:
+                del results[stage.parent]
+        return {output: results[output] for output in outputs}, timings
+
+
+def estimate_text_height(gray_image):
+    binary = cv2.adaptiveThreshold(gray_image, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+    text_rows = np.concatenate(([0], (binary.mean(axis=1) > TEXT_ROW_INK_RATIO).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(text_rows))
+    heights = edges[1::2] - edges[::2]
+    heights = heights[heights >= MIN_TEXT_HEIGHT]
+    return float(np.median(heights)) if len(heights) else None
+
+
+def decode(path, context):
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Can't decode image {}".format(path))
+    return image
+
+
+def rescale(image, context):
+    text_height = estimate_text_height(image)
+    scale = 1.0
+    if text_height:
+        scale = min(max(context["target_text_height"] / text_height, context["min_scale"]), context["max_scale"])
+        scale = 1.0 if abs(scale - 1) < 0.1 else scale
+    context["scale"], context["text_height"] = scale, text_height
+
+    scale *= ENHANCEMENT_SCALE
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+def binarize(image, context):
+    buffer = cv2.GaussianBlur(image, (5, 5), 0)
+    cv2.threshold(buffer, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=image)
+    cv2.bilateralFilter(image, 5, 75, 75, dst=buffer)
+    cv2.threshold(buffer, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=image)
+    cv2.bilateralFilter(image, 9, 75, 75, dst=buffer)
+    cv2.adaptiveThreshold(buffer, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2, dst=image)
+    return image
+
+
+def sharpen(image, context):
+    cv2.normalize(image, image, 0, 255, cv2.NORM_MINMAX)
+    blurred = cv2.GaussianBlur(image, (0, 0), SHARPEN_SIGMA)
+    cv2.addWeighted(image, 2.0, blurred, -1.0, 0, dst=image)
+    cv2.LUT(image, CONTRAST_LUT, dst=image)
+    return image
+
+
+RECEIPT_GRAPH = PreprocessingGraph(
+    Stage("decode", None, decode, inplace=False),
+    Stage("rescale", "decode", rescale, inplace=False),
+    Stage("binarize", "rescale", binarize, inplace=True),
+    Stage("sharpen_binarized", "binarize", sharpen, inplace=True),
+    Stage("sharpen_plain", "rescale", sharpen, inplace=True)
+)
@@ -8,11 +8,13 @@ from datetime import datetime
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
+from urllib.parse import urlparse
 
 import requests
 from dotenv import load_dotenv
 
 from utils.logger import behavior_log
+from utils.metrics import stage_timer, EXTERNAL_REQUEST_DURATION, EXTERNAL_REQUEST_ERRORS
 from services.fields import ITEMS, NAME, QUANTITY, PRICE, SUM
 from bot_config import FEDERAL_TAX_LOGIN, FEDERAL_TAX_PASSWORD, FEDERAL_TAX_SECRET_TOKEN, \
     CREDENTIALS_PATH, CONNECT_TIMEOUT, READ_TIMEOUT
@@ -42,8 +44,7 @@ class QRParser:
 
     def __init__(self):
         self.__session_id = None
-        self._set_session_id()
-        behavior_log("Init {parser}".format(parser=type(self).__name__))
+        behavior_log("Init {parser}", parser=type(self).__name__)
 
     @property
     def headers(self):
@@ -74,16 +75,21 @@ class QRParser:
     @staticmethod
     def request_handling(method, url, **kwargs):
         response = {}
+        service = urlparse(url).hostname
         try:
-            if method == Methods.GET:
-                response = requests.get(url=url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
-            elif method == Methods.POST:
-                response = requests.post(url=url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+            with EXTERNAL_REQUEST_DURATION.time(service=service):
+                if method == Methods.GET:
+                    response = requests.get(url=url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+                elif method == Methods.POST:
+                    response = requests.post(url=url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
         except requests.exceptions.RequestException:
+            EXTERNAL_REQUEST_ERRORS.inc(service=service)
             behavior_log("Request exception occurred", level="ERROR", exc_info=True)
         finally:
             if hasattr(response, "text") and hasattr(response, "status_code"):
-                behavior_log("Obtain response from {url}: {response}".format(url=url, response=response.text))
+                behavior_log("Obtain response from {url}: {response}", level="DEBUG", url=url, response=response.text)
+                if response.status_code != 200:
+                    EXTERNAL_REQUEST_ERRORS.inc(service=service)
                 return response.json() if response.status_code == 200 else {}
             else:
                 return {}
@@ -95,47 +101,56 @@ class QRParser:
         session_id = resp["sessionId"] if resp else None
         self.__session_id = session_id
 
+    def authenticate(self) -> bool:
+        if self.__session_id is None:
+            self._set_session_id()
+        return self.__session_id is not None
+
     def _get_ticket_id(self, qr: str) -> str:
-        behavior_log("Fetch ticket id from {url}".format(url=self.TICKET_URL))
+        behavior_log("Fetch ticket id from {url}", url=self.TICKET_URL)
         resp = self.request_handling(method=Methods.POST, url=self.TICKET_URL,
                                      json={"qr": qr}, headers=self.headers_with_session)
         ticket_id = resp["id"] if resp else ""
         return ticket_id
 
     def _get_federal_tax_ticket(self, qr: str) -> dict:
+        self.authenticate()
         ticket_id = self._get_ticket_id(qr)
         ticket_description_url = self.TICKETS_URL + ticket_id
-        behavior_log("Fetch ticket description by id={id} from {url}".format(id=ticket_id, url=self.TICKET_URL))
+        behavior_log("Fetch ticket description by id={ticket_id} from {url}", ticket_id=ticket_id, url=self.TICKET_URL)
         resp = self.request_handling(method=Methods.GET, url=ticket_description_url,
                                      headers=self.headers_with_session)
         ticket = resp.get("ticket")
         if ticket:
             receipt = ticket["document"]["receipt"]
-            behavior_log("Successful federal tax service receipt obtaining: receipt={receipt}".format(receipt=receipt))
+            behavior_log("Successful federal tax service receipt obtaining: receipt={receipt}", level="DEBUG", receipt=receipt)
             return receipt
         else:
             behavior_log("Fail to obtain receipt from FTS")
             return {}
 
     def _get_backup_ofd_ticket(self, qr: str) -> dict:
-        behavior_log("Fetch ticket description for qr code '{qr}' from backup URL: {url}".format(qr=qr, url=self.BACKUP_TICKETS_URL))
+        behavior_log("Fetch ticket description for qr code '{qr}' from backup URL: {url}", qr=qr, url=self.BACKUP_TICKETS_URL)
         command = 'curl --data "{qr}" {host}'.format(qr=qr, host=self.BACKUP_TICKETS_URL)
-        pipe = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=sys.stderr)
-        if not pipe.stderr:
-            try:
-                stdout = pipe.stdout.read().decode()
-                resp = json.loads(stdout)
-            except JSONDecodeError:
-                return {}
-            ticket = resp.get("data")
-            if isinstance(ticket, dict):
-                receipt = ticket["json"]
-                behavior_log("Successful backup OFD receipt obtaining: receipt={receipt}".format(receipt=receipt))
-                return receipt
-            else:
-                behavior_log("Fail to obtain receipt from backup OFD")
+        service = urlparse(self.BACKUP_TICKETS_URL).hostname
+        with EXTERNAL_REQUEST_DURATION.time(service=service):
+            pipe = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=sys.stderr)
+            if pipe.stderr:
                 return {}
+            stdout = pipe.stdout.read().decode()
+
+        try:
+            resp = json.loads(stdout)
+        except JSONDecodeError:
+            EXTERNAL_REQUEST_ERRORS.inc(service=service)
+            return {}
+        ticket = resp.get("data")
+        if isinstance(ticket, dict):
+            receipt = ticket["json"]
+            behavior_log("Successful backup OFD receipt obtaining: receipt={receipt}", level="DEBUG", receipt=receipt)
+            return receipt
         else:
+            behavior_log("Fail to obtain receipt from backup OFD")
             return {}
 
     def _ticket_processing(self, ticket):
@@ -183,7 +198,7 @@ class QRParser:
     async def get_ticket_items(self, qr: str):
         loop = asyncio.get_running_loop()
         behavior_log("Get running loop for asynchronous ticket fetch")
-        with ThreadPoolExecutor() as pool:
+        with ThreadPoolExecutor() as pool, stage_timer("ticket_fetch"):
             futures = [
                 loop.run_in_executor(pool, partial(self._get_federal_tax_ticket, qr=qr)),
                 loop.run_in_executor(pool, partial(self._get_backup_ofd_ticket, qr=qr))
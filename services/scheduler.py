@@ -0,0 +1,132 @@
+import time
+import asyncio
+from collections import OrderedDict, deque
+
+from utils.logger import behavior_log
+from utils.metrics import SCHEDULER_QUEUED, SCHEDULER_RUNNING, SCHEDULER_REJECTED, SCHEDULER_WAIT
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.rejected = False
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def consume(self, cost=1):
+        self.refill()
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost=1):
+        return max(min(cost, self.capacity) - self.tokens, 0) / self.rate
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after, notify):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.notify = notify
+
+
+class FairScheduler:
+    RATE_LIMITED, OVERLOADED = "rate_limited", "overloaded"
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, pipeline, concurrency, rate, burst, max_queued):
+        self.pipeline = pipeline
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self._buckets = dict()
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._running = 0
+
+        SCHEDULER_QUEUED.set_function(lambda: self._queued, pipeline=pipeline)
+        SCHEDULER_RUNNING.set_function(lambda: self._running, pipeline=pipeline)
+
+    def bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_IDLE_BUCKETS:
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.is_full()}
+            bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def admit(self, chat_id, cost=1):
+        bucket = self.bucket(chat_id)
+        if self._queued + cost > self.max_queued:
+            self.reject(chat_id, bucket, self.OVERLOADED, retry_after=None)
+        if not bucket.consume(cost):
+            self.reject(chat_id, bucket, self.RATE_LIMITED, retry_after=bucket.retry_after(cost))
+        bucket.rejected = False
+
+    def reject(self, chat_id, bucket, reason, retry_after):
+        notify, bucket.rejected = not bucket.rejected, True
+        SCHEDULER_REJECTED.inc(pipeline=self.pipeline, reason=reason)
+        behavior_log(
+            "User: {chat_id}, Rejected {pipeline} job: {reason}",
+            level="WARNING", chat_id=chat_id, pipeline=self.pipeline, reason=reason
+        )
+        raise Rejected(reason, retry_after, notify)
+
+    async def run(self, chat_id, job, *args):
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, deque()).append(waiter)
+        self._queued += 1
+        queued_at = time.perf_counter()
+        self.dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                self.forget(chat_id, waiter)
+            else:
+                self.release()
+            raise
+
+        SCHEDULER_WAIT.observe(time.perf_counter() - queued_at, pipeline=self.pipeline)
+        try:
+            return await job(*args)
+        finally:
+            self.release()
+
+    def forget(self, chat_id, waiter):
+        queue = self._queues.get(chat_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self._queued -= 1
+            if not queue:
+                del self._queues[chat_id]
+
+    def release(self):
+        self._running -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self._running < self.concurrency and self._queues:
+            chat_id, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._queues.move_to_end(chat_id)
+            else:
+                del self._queues[chat_id]
+            if not waiter.done():
+                self._running += 1
+                waiter.set_result(None)
@@ -0,0 +1,114 @@
+import os
+import time
+import random
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from bot_config import TMP_FOLDER, SAMPLES_FOLDER
+from utils.logger import behavior_log
+from utils.metrics import SCRATCH_JOBS, SCRATCH_ACTIVE_JOBS, SCRATCH_BYTES, SCRATCH_RETAINED, SCRATCH_EVICTED
+
+
+def folder_size(path):
+    size = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                pass
+    return size
+
+
+class ScratchJob:
+    def __init__(self, path):
+        self.path = path
+        self.retain_reason = None
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def retain(self, reason):
+        self.retain_reason = reason
+
+
+class ScratchStorage:
+    TMPFS_PATH = "/dev/shm"
+    TMPFS_MIN_FREE_BYTES = 256 * 1024 ** 2
+    SCRATCH_DIR = "receipt_bot"
+    JOB_PREFIX = "job-"
+    STALE_JOB_SECONDS = 60 * 60
+    SAMPLES_LIMIT_BYTES = 200 * 1024 ** 2
+    SUCCESS_SAMPLE_RATE = 0.02
+    SUCCESS, FAILED, UNRECOGNIZED, SAMPLE = "success", "failed", "unrecognized", "sample"
+
+    def __init__(self, samples_folder=SAMPLES_FOLDER, fallback_folder=TMP_FOLDER):
+        self.root = os.path.join(self.choose_base_folder(fallback_folder), self.SCRATCH_DIR)
+        self.samples_folder = samples_folder
+        self._active_jobs = 0
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.samples_folder, exist_ok=True)
+        self.remove_stale_jobs()
+
+        SCRATCH_ACTIVE_JOBS.set_function(lambda: self._active_jobs)
+        SCRATCH_BYTES.set_function(lambda: folder_size(self.root), area="scratch")
+        SCRATCH_BYTES.set_function(lambda: folder_size(self.samples_folder), area="samples")
+        behavior_log("Init {storage} in {root}", storage=type(self).__name__, root=self.root)
+
+    def choose_base_folder(self, fallback_folder):
+        try:
+            if os.access(self.TMPFS_PATH, os.W_OK) and \
+                    shutil.disk_usage(self.TMPFS_PATH).free >= self.TMPFS_MIN_FREE_BYTES:
+                return self.TMPFS_PATH
+        except OSError:
+            pass
+        return fallback_folder
+
+    def remove_stale_jobs(self):
+        for entry in os.scandir(self.root):
+            if entry.name.startswith(self.JOB_PREFIX) and \
+                    time.time() - entry.stat().st_mtime > self.STALE_JOB_SECONDS:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    @contextmanager
+    def job(self):
+        job = ScratchJob(tempfile.mkdtemp(prefix=self.JOB_PREFIX, dir=self.root))
+        self._active_jobs += 1
+        try:
+            yield job
+        except Exception:
+            job.retain(self.FAILED)
+            raise
+        finally:
+            self._active_jobs -= 1
+            SCRATCH_JOBS.inc(outcome=job.retain_reason or self.SUCCESS)
+            if job.retain_reason is None and random.random() < self.SUCCESS_SAMPLE_RATE:
+                job.retain(self.SAMPLE)
+            if job.retain_reason is not None:
+                try:
+                    self.retain_sample(job)
+                except OSError:
+                    behavior_log("Failed to retain scratch job {path}", level="ERROR", exc_info=True, path=job.path)
+            shutil.rmtree(job.path, ignore_errors=True)
+
+    def retain_sample(self, job):
+        job_id = os.path.basename(job.path)[len(self.JOB_PREFIX):]
+        for name in os.listdir(job.path):
+            sample_name = "{timestamp}-{reason}-{job_id}-{name}".format(
+                timestamp=int(time.time()), reason=job.retain_reason, job_id=job_id, name=name
+            )
+            shutil.move(job.file(name), os.path.join(self.samples_folder, sample_name))
+            SCRATCH_RETAINED.inc(reason=job.retain_reason)
+        behavior_log("Retained scratch job {job_id} as {reason} sample", job_id=job_id, reason=job.retain_reason)
+        self.enforce_samples_limit()
+
+    def enforce_samples_limit(self):
+        samples = sorted(os.scandir(self.samples_folder), key=lambda entry: entry.stat().st_mtime)
+        samples_size = sum(entry.stat().st_size for entry in samples)
+        for entry in samples:
+            if samples_size <= self.SAMPLES_LIMIT_BYTES:
+                break
+            samples_size -= entry.stat().st_size
+            os.remove(entry.path)
+            SCRATCH_EVICTED.inc()
@@ -0,0 +1,135 @@
+import math
+from fractions import Fraction
+from collections import namedtuple
+
+from services.fields import PRICE, QUANTITY
+
+
+ClaimChange = namedtuple(
+    "ClaimChange", ["user_id", "item_id", "previous_units", "units", "item_units", "user_value", "claimed_value"]
+)
+
+
+class Settlement:
+    KOPECKS_IN_RUBLE = 100
+
+    def __init__(self, items, total_voters_count=1, scale=None, total_value=None, claimed_value=0,
+                 claims=None, claimed_units=None, user_totals=None):
+        self.items = items
+        self.units_per_quantity = total_voters_count or 1
+        self.scale = scale or self.value_scale(items, self.units_per_quantity)
+        if total_value is None:
+            total_value = sum(self.max_units(item_id) * self.unit_value(item_id) for item_id in range(len(items)))
+        self.total_value = total_value
+        self.claimed_value = claimed_value
+        self.claims = {} if claims is None else claims
+        self.claimed_units = {} if claimed_units is None else claimed_units
+        self.user_totals = {} if user_totals is None else user_totals
+        self.changes = []
+
+    @staticmethod
+    def item_price(item):
+        return Fraction(str(item[PRICE]))
+
+    @staticmethod
+    def item_quantity(item):
+        return int(item[QUANTITY]) or 1
+
+    @classmethod
+    def value_scale(cls, items, units_per_quantity):
+        scale = 1
+        for item in items:
+            price_kopecks = cls.item_price(item) * cls.KOPECKS_IN_RUBLE
+            step = cls.item_quantity(item) * price_kopecks.denominator
+            scale = scale * step // math.gcd(scale, step)
+        return scale * units_per_quantity
+
+    def unit_value(self, item_id):
+        item = self.items[item_id]
+        price_kopecks = self.item_price(item) * self.KOPECKS_IN_RUBLE
+        return int(price_kopecks * self.scale / (self.item_quantity(item) * self.units_per_quantity))
+
+    def to_rubles(self, value):
+        return Fraction(value, self.scale * self.KOPECKS_IN_RUBLE)
+
+    def item_units(self, item_id):
+        return self.claimed_units.get(str(item_id), 0)
+
+    def max_units(self, item_id):
+        return self.item_quantity(self.items[item_id]) * self.units_per_quantity
+
+    def user_units(self, user_id, item_id):
+        return self.claims.get(str(item_id), {}).get(user_id, 0)
+
+    def user_claim(self, user_id, item_id):
+        return Fraction(self.user_units(user_id, item_id), self.units_per_quantity)
+
+    def set_claim(self, user_id, item_id, quantity):
+        units = int(quantity * self.units_per_quantity)
+        previous_units = self.user_units(user_id, item_id)
+        if units == previous_units:
+            return None
+
+        item_units, max_units = self.item_units(item_id), self.max_units(item_id)
+        claimed_units = item_units + units - previous_units
+        change = ClaimChange(
+            user_id=user_id,
+            item_id=item_id,
+            previous_units=previous_units,
+            units=units,
+            item_units=item_units,
+            user_value=(units - previous_units) * self.unit_value(item_id),
+            claimed_value=(min(claimed_units, max_units) - min(item_units, max_units)) * self.unit_value(item_id)
+        )
+        item_claims = self.claims.setdefault(str(item_id), {})
+        if units:
+            item_claims[user_id] = units
+        else:
+            item_claims.pop(user_id, None)
+        self.claimed_units[str(item_id)] = claimed_units
+        self.user_totals[user_id] = self.user_totals.get(user_id, 0) + change.user_value
+        self.claimed_value += change.claimed_value
+        self.changes.append(change)
+        return change
+
+    def user_share(self, user_id):
+        return self.to_rubles(self.user_totals.get(user_id, 0))
+
+    @property
+    def total(self):
+        return self.to_rubles(self.total_value)
+
+    @property
+    def unclaimed_total(self):
+        return self.to_rubles(self.total_value - self.claimed_value)
+
+    def unclaimed_items(self):
+        return {
+            item_id: Fraction(self.max_units(item_id) - self.item_units(item_id), self.units_per_quantity)
+            for item_id in range(len(self.items))
+            if self.item_units(item_id) < self.max_units(item_id)
+        }
+
+    def exact_debts(self):
+        debts = {user_id: self.to_rubles(value) for user_id, value in self.user_totals.items()}
+        for item_id, item_units in self.claimed_units.items():
+            item_id = int(item_id)
+            if item_units <= self.max_units(item_id):
+                continue
+            price = self.item_price(self.items[item_id])
+            for user_id, units in self.claims[str(item_id)].items():
+                debts[user_id] += price * units / item_units - self.to_rubles(units * self.unit_value(item_id))
+        return debts
+
+    def debts(self):
+        exact_debts = self.exact_debts()
+        kopecks = {user_id: math.floor(debt * self.KOPECKS_IN_RUBLE) for user_id, debt in exact_debts.items()}
+        remainder = round(sum(exact_debts.values(), Fraction(0)) * self.KOPECKS_IN_RUBLE) - sum(kopecks.values())
+
+        by_fraction_loss = sorted(
+            exact_debts,
+            key=lambda user_id: (kopecks[user_id] - exact_debts[user_id] * self.KOPECKS_IN_RUBLE, user_id)
+        )
+        for user_id in by_fraction_loss[:remainder]:
+            kopecks[user_id] += 1
+        return kopecks
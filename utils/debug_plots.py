@@ -0,0 +1,12 @@
+import cv2
+import matplotlib.pyplot as plt
+
+
+def plot_rgb(image):
+    plt.figure(figsize=(16, 10))
+    return plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+
+def plot_gray(image):
+    plt.figure(figsize=(16, 10))
+    return plt.imshow(image, cmap='Greys_r')
@@ -1,18 +1,117 @@
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import reprlib
 import logging.config
+import logging.handlers
+from contextlib import contextmanager
 
-from bot_config import get_config, LOGGING_CONFIG_PATH, LOGGER_NAME
+from bot_config import get_config, LOGGING_CONFIG_PATH, LOGGER_NAME, LOG_LEVEL
 
 behavior_logger = logging.getLogger(LOGGER_NAME)
 
+MAX_FIELD_LEN = 512
+FIELDS_ATTR = "fields"
+SCALAR_TYPES = (int, float, bool, str, type(None))
+
+_field_repr = reprlib.Repr()
+_field_repr.maxstring = MAX_FIELD_LEN
+_field_repr.maxother = MAX_FIELD_LEN
+_field_repr.maxdict = _field_repr.maxlist = _field_repr.maxtuple = _field_repr.maxset = 20
+_field_repr.maxlevel = 3
+
+_queue_listener = None
+
+
+class LazyMessage:
+    def __init__(self, template, fields):
+        self.template = template
+        self.fields = fields
+
+    def __str__(self):
+        try:
+            return self.template.format(**self.fields)
+        except (KeyError, IndexError, ValueError):
+            return self.template
+
+
+class NonFormattingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage()
+        }
+        payload.update(getattr(record, FIELDS_ATTR, {}))
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def truncate_field(value):
+    if isinstance(value, str):
+        return value if len(value) <= MAX_FIELD_LEN else value[:MAX_FIELD_LEN] + "..."
+    if isinstance(value, SCALAR_TYPES):
+        return value
+    return _field_repr.repr(value)
+
 
 def init_logger():
+    global _queue_listener
     config = get_config(LOGGING_CONFIG_PATH)
     logging.config.dictConfig(config)
+    if os.getenv(LOG_LEVEL):
+        behavior_logger.setLevel(os.getenv(LOG_LEVEL).upper())
+
+    handlers = list(behavior_logger.handlers)
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        behavior_logger.removeHandler(handler)
+    behavior_logger.addHandler(NonFormattingQueueHandler(log_queue))
+
+    _queue_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _queue_listener.start()
+    atexit.register(stop_logger)
+
 
+def stop_logger():
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
 
-def behavior_log(message, level="INFO", exc_info=None):
+
+def behavior_log(message, level="INFO", exc_info=None, sample_rate=None, **fields):
     try:
         level_name = logging.getLevelName(level)
-        behavior_logger.log(level_name, message, exc_info=exc_info)
+        if not behavior_logger.isEnabledFor(level_name):
+            return
+        if sample_rate is not None and random.random() >= sample_rate:
+            return
+
+        fields = {key: truncate_field(value) for key, value in fields.items()}
+        behavior_logger.log(level_name, LazyMessage(message, fields), exc_info=exc_info, extra={FIELDS_ATTR: fields})
     except:
         behavior_logger.log(logging.getLevelName("ERROR"), "behavior_log: Failed to write a log", exc_info=True)
+
+
+@contextmanager
+def log_stage(stage, level="DEBUG", **fields):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        behavior_log(
+            "Stage {stage} finished in {duration:.3f}s", level=level,
+            stage=stage, duration=time.perf_counter() - start_time, **fields
+        )
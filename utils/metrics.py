@@ -0,0 +1,323 @@
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from utils.logger import behavior_log, log_stage
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _label_values(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    @staticmethod
+    def _escape(value):
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def _format_labels(self, label_values, **extra_labels):
+        pairs = list(zip(self.labelnames, label_values)) + list(extra_labels.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(key, self._escape(value)) for key, value in pairs) + "}"
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in values.items():
+            yield self.name + self._format_labels(label_values), value
+
+    def render(self):
+        lines = [
+            "# HELP {name} {description}".format(name=self.name, description=self.description),
+            "# TYPE {name} {type}".format(name=self.name, type=self.TYPE)
+        ]
+        for sample_name, value in self.samples():
+            lines.append("{sample} {value}".format(sample=sample_name, value=float(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name, description, labelnames=()):
+        super().__init__(name, description, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._label_values(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def set_function(self, function, **labels):
+        with self._lock:
+            self._functions[self._label_values(labels)] = function
+
+    def samples(self):
+        yield from super().samples()
+        with self._lock:
+            functions = dict(self._functions)
+        for label_values, function in functions.items():
+            yield self.name + self._format_labels(label_values), function()
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def totals(self):
+        with self._lock:
+            return {
+                ",".join(label_values): {"count": sum(counts), "sum": total}
+                for label_values, (counts, total) in self._values.items()
+            }
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for label_values, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bound_view = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield self.name + "_bucket" + self._format_labels(label_values, le=bound_view), cumulative
+            yield self.name + "_sum" + self._format_labels(label_values), total
+            yield self.name + "_count" + self._format_labels(label_values), cumulative
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labelnames=()):
+        return self.register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=()):
+        return self.register(Gauge(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_DURATION = registry.histogram(
+    "receipt_bot_stage_duration_seconds", "Duration of receipt processing stages", ["stage"]
+)
+STAGE_ERRORS = registry.counter(
+    "receipt_bot_stage_errors_total", "Failed receipt processing stages", ["stage"]
+)
+EXTERNAL_REQUEST_DURATION = registry.histogram(
+    "receipt_bot_external_request_duration_seconds", "Duration of requests to external services", ["service"]
+)
+EXTERNAL_REQUEST_ERRORS = registry.counter(
+    "receipt_bot_external_request_errors_total", "Failed requests to external services", ["service"]
+)
+MONGO_QUERY_DURATION = registry.histogram(
+    "receipt_bot_mongo_query_duration_seconds", "Duration of MongoDB operations", ["operation", "collection"]
+)
+TELEGRAM_REQUEST_DURATION = registry.histogram(
+    "receipt_bot_telegram_request_duration_seconds", "Duration of Telegram Bot API calls", ["method"]
+)
+OCR_POOL_WORKERS = registry.gauge(
+    "receipt_bot_ocr_pool_workers", "Number of OCR worker processes"
+)
+OCR_POOL_BUSY = registry.gauge(
+    "receipt_bot_ocr_pool_busy_jobs", "OCR jobs submitted to the worker pool and not finished yet"
+)
+OCR_POOL_QUEUE_DEPTH = registry.gauge(
+    "receipt_bot_ocr_pool_queue_depth", "OCR jobs waiting for a free worker"
+)
+PHOTO_LONG_SIDE = registry.histogram(
+    "receipt_bot_photo_long_side_pixels", "Long side of the Telegram photo size chosen for OCR",
+    buckets=(320, 640, 800, 1280, 1600, 2560)
+)
+OCR_IMAGE_SCALE = registry.histogram(
+    "receipt_bot_ocr_image_scale", "Rescale factor applied to photos before enhancement",
+    buckets=(0.25, 0.5, 0.75, 0.9, 1.1, 1.5, 2, 3)
+)
+SCRATCH_JOBS = registry.counter(
+    "receipt_bot_scratch_jobs_total", "Finished scratch storage jobs", ["outcome"]
+)
+SCRATCH_ACTIVE_JOBS = registry.gauge(
+    "receipt_bot_scratch_active_jobs", "Scratch storage jobs in progress"
+)
+SCRATCH_BYTES = registry.gauge(
+    "receipt_bot_scratch_bytes", "Disk usage of scratch storage", ["area"]
+)
+SCRATCH_RETAINED = registry.counter(
+    "receipt_bot_scratch_retained_files_total", "Scratch files kept as debugging samples", ["reason"]
+)
+SCRATCH_EVICTED = registry.counter(
+    "receipt_bot_scratch_evicted_samples_total", "Debugging samples removed by the size limit"
+)
+SCHEDULER_QUEUED = registry.gauge(
+    "receipt_bot_scheduler_queued_jobs", "Admitted jobs waiting for a pipeline slot", ["pipeline"]
+)
+SCHEDULER_RUNNING = registry.gauge(
+    "receipt_bot_scheduler_running_jobs", "Jobs holding a pipeline slot", ["pipeline"]
+)
+SCHEDULER_REJECTED = registry.counter(
+    "receipt_bot_scheduler_rejected_jobs_total", "Jobs rejected by admission control", ["pipeline", "reason"]
+)
+SCHEDULER_WAIT = registry.histogram(
+    "receipt_bot_scheduler_wait_seconds", "Time admitted jobs waited for a pipeline slot", ["pipeline"]
+)
+DUPLICATE_UPDATES = registry.counter(
+    "receipt_bot_duplicate_updates_total", "Redelivered updates and repeated actions skipped by deduplication", ["kind"]
+)
+COMPONENT_READY = registry.gauge(
+    "receipt_bot_component_ready", "Whether a bot dependency finished its initialization", ["component"]
+)
+
+
+@contextmanager
+def stage_timer(stage, **fields):
+    with log_stage(stage, **fields), STAGE_DURATION.time(stage=stage):
+        try:
+            yield
+        except Exception:
+            STAGE_ERRORS.inc(stage=stage)
+            raise
+
+
+class Readiness:
+    STARTING = "starting"
+    READY = "ready"
+
+    def __init__(self, *components):
+        self._events = {component: asyncio.Event() for component in components}
+        self._errors = dict()
+        for component in components:
+            COMPONENT_READY.set(0, component=component)
+
+    def set_ready(self, component):
+        self._errors.pop(component, None)
+        self._events[component].set()
+        COMPONENT_READY.set(1, component=component)
+
+    def set_failed(self, component, error):
+        self._errors[component] = str(error) or type(error).__name__
+        COMPONENT_READY.set(0, component=component)
+
+    def is_ready(self, component=None):
+        components = [component] if component else self._events
+        return all(self._events[name].is_set() for name in components)
+
+    async def wait(self, component, timeout=None):
+        try:
+            await asyncio.wait_for(self._events[component].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_ready(component)
+
+    def status(self):
+        return {
+            component: self.READY if event.is_set() else self._errors.get(component, self.STARTING)
+            for component, event in self._events.items()
+        }
+
+
+class MetricsServer:
+    METRICS_PATH = "/metrics"
+    READY_PATH = "/ready"
+    PROFILE_PATH = "/profile"
+    CONTENT_TYPE = "text/plain"
+
+    def __init__(self, host, port, metrics_registry=registry, readiness=None, profiler=None):
+        self.host = host
+        self.port = port
+        self._registry = metrics_registry
+        self._readiness = readiness
+        self._profiler = profiler
+        self._runner = None
+
+    async def metrics_handler(self, request):
+        return web.Response(text=self._registry.render(), content_type=self.CONTENT_TYPE)
+
+    async def ready_handler(self, request):
+        status = self._readiness.status() if self._readiness else {}
+        is_ready = self._readiness is None or self._readiness.is_ready()
+        return web.json_response(status, status=200 if is_ready else 503)
+
+    async def profile_handler(self, request):
+        if self._profiler is None:
+            raise web.HTTPNotFound()
+        try:
+            duration = int(request.query.get("seconds", self._profiler.DEFAULT_DURATION))
+        except ValueError:
+            raise web.HTTPBadRequest(text="seconds must be an integer")
+        report = await self._profiler.profile(duration)
+        if report is None:
+            raise web.HTTPConflict(text="Profiling is already running")
+        return web.json_response(report)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(self.METRICS_PATH, self.metrics_handler)
+        app.router.add_get(self.READY_PATH, self.ready_handler)
+        app.router.add_post(self.PROFILE_PATH, self.profile_handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        behavior_log("Metrics are exposed on http://{host}:{port}{path}", host=self.host, port=self.port,
+                     path=self.METRICS_PATH)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+
+from bot_config import PROFILES_FOLDER
+from utils.logger import behavior_log
+
+
+def frame_name(frame):
+    code = frame.f_code
+    name = "{}:{}".format(frame.f_globals.get("__name__", code.co_filename), getattr(code, "co_qualname", code.co_name))
+    return name.replace(";", ":").replace(" ", "_")
+
+
+class StackSampler(threading.Thread):
+    HISTORY_SECONDS = 10
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._history = deque(maxlen=int(self.HISTORY_SECONDS / interval))
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            with self._lock:
+                self.stacks[stack] += 1
+                self._history.append((time.time(), stack))
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def stacks_between(self, start_time, end_time):
+        with self._lock:
+            return [stack for timestamp, stack in self._history if start_time <= timestamp <= end_time]
+
+    def folded(self):
+        with self._lock:
+            return ["{} {}".format(";".join(stack), count) for stack, count in self.stacks.most_common()]
+
+
+class SlowCallbackCollector(logging.Handler):
+    SLOW_CALLBACK_MESSAGE = "Executing %s took %.3f seconds"
+    TASK_REGEXP = re.compile(r"coro=<([\w.]+)\(\)")
+    HANDLER_MODULES = ("bot.",)
+
+    def __init__(self, sampler):
+        super().__init__(level=logging.WARNING)
+        self.sampler = sampler
+        self.callbacks = dict()
+
+    def emit(self, record):
+        if record.msg != self.SLOW_CALLBACK_MESSAGE:
+            return
+        handle, duration = record.args
+        stacks = self.sampler.stacks_between(record.created - duration, record.created)
+        handlers = Counter(self.innermost_handler(stack) for stack in stacks)
+        task = self.TASK_REGEXP.search(str(handle))
+        handler = handlers.most_common(1)[0][0] if handlers else None
+        name = handler or (task.group(1) if task else str(handle))
+
+        callback = self.callbacks.setdefault(name, dict(count=0, total=0.0, max=0.0, blocked_in=Counter()))
+        callback["count"] += 1
+        callback["total"] += duration
+        callback["max"] = max(callback["max"], duration)
+        callback["blocked_in"].update(stack[-1] for stack in stacks if stack)
+
+    def innermost_handler(self, stack):
+        for name in reversed(stack):
+            if name.startswith(self.HANDLER_MODULES):
+                return name
+
+    def report(self):
+        callbacks = [
+            dict(callback=name, count=callback["count"], total=round(callback["total"], 3),
+                 max=round(callback["max"], 3), blocked_in=[name for name, _ in callback["blocked_in"].most_common(3)])
+            for name, callback in self.callbacks.items()
+        ]
+        return sorted(callbacks, key=lambda callback: callback["total"], reverse=True)
+
+
+class Profiler:
+    DEFAULT_DURATION, MAX_DURATION = 30, 300
+    SAMPLE_INTERVAL = 0.005
+    SLOW_CALLBACK_SECONDS = 0.1
+    ASYNCIO_LOGGER = "asyncio"
+
+    def __init__(self, output_folder=PROFILES_FOLDER):
+        self.output_folder = output_folder
+        self.is_running = False
+
+    async def profile(self, duration=DEFAULT_DURATION):
+        if self.is_running:
+            return None
+        duration = min(max(duration, 1), self.MAX_DURATION)
+        loop = asyncio.get_running_loop()
+        sampler = StackSampler(threading.get_ident(), self.SAMPLE_INTERVAL)
+        collector = SlowCallbackCollector(sampler)
+        asyncio_logger = logging.getLogger(self.ASYNCIO_LOGGER)
+        debug, slow_callback_duration = loop.get_debug(), loop.slow_callback_duration
+
+        self.is_running = True
+        behavior_log("Start profiling for {duration} s", duration=duration)
+        asyncio_logger.addHandler(collector)
+        loop.slow_callback_duration = self.SLOW_CALLBACK_SECONDS
+        loop.set_debug(True)
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            sampler.stop()
+            loop.set_debug(debug)
+            loop.slow_callback_duration = slow_callback_duration
+            asyncio_logger.removeHandler(collector)
+            self.is_running = False
+        return self.save(sampler, collector, duration)
+
+    def save(self, sampler, collector, duration):
+        os.makedirs(self.output_folder, exist_ok=True)
+        name = "profile-{}".format(time.strftime("%Y%m%d-%H%M%S"))
+        report = {
+            "duration": duration,
+            "samples": sum(sampler.stacks.values()),
+            "slow_callback_seconds": self.SLOW_CALLBACK_SECONDS,
+            "slow_callbacks": collector.report(),
+            "flamegraph": os.path.join(self.output_folder, name + ".folded")
+        }
+        with open(report["flamegraph"], "w") as f:
+            f.write("\n".join(sampler.folded()) + "\n")
+        with open(os.path.join(self.output_folder, name + ".json"), "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        behavior_log("Profile is saved to {path}", path=report["flamegraph"], samples=report["samples"])
+        return report